@@ -0,0 +1,221 @@
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+# Run from anywhere, the shared helpers and the scripts live one level up
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+from microbio_tools.grouping import group_biom_tsv, group_sum, split_replicates, treatment_mapping
+from microbio_tools.loaders import BiomTsv, SparseFeatureTable
+from microbio_tools.synthetic import synthetic_metadata, synthetic_table, write_biom_tsv
+
+STAGES = ['load', 'group', 'split', 'top_n', 'render', 'write', 'stream_group', 'stream_top_n']
+
+
+def current_rss():
+    # Resident set size in bytes, psutil ships with the qiime2 environment
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageMonitor:
+    # Wall time and peak RSS of one stage, RSS is sampled on a background thread
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.results = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start_rss = current_rss()
+        peak = [start_rss]
+        done = threading.Event()
+
+        def sample():
+            while not done.is_set():
+                peak[0] = max(peak[0], current_rss())
+                done.wait(self.interval)
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            done.set()
+            sampler.join()
+            peak[0] = max(peak[0], current_rss())
+            self.results[name] = {'seconds': round(seconds, 6),
+                                  'peak_rss_mb': round(peak[0] / 2**20, 2),
+                                  'rss_delta_mb': round((peak[0] - start_rss) / 2**20, 2)}
+
+
+def load_summarizer():
+    # The summarizer is a hyphenated script so it has to be imported by path
+    path = os.path.join(REPO_DIR, 'taxa-abundance-summarizer.py')
+    spec = importlib.util.spec_from_file_location('taxa_abundance_summarizer', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class FrameMetadata:
+    # Used in place of qiime2 Metadata when qiime2 is not installed, only provides
+    # the get_column(...).to_series() call the grouping helpers use
+
+    def __init__(self, frame):
+        self.frame = frame
+
+    def get_column(self, column):
+        series = self.frame[column]
+        return type('Column', (), {'to_series': lambda self: series})()
+
+
+def make_metadata(frame):
+    try:
+        from qiime2 import Metadata
+        return Metadata(frame)
+    except ImportError:
+        return FrameMetadata(frame)
+
+
+def run_case(n_features, n_samples, n_treatments, num, density, seed, summarizer, workdir, render=True):
+    monitor = StageMonitor()
+    table = synthetic_table(n_features, n_samples, density=density, seed=seed)
+    metadata = make_metadata(synthetic_metadata(table.samples, n_treatments, seed=seed))
+    treatments = [f'T{i}' for i in range(n_treatments)]
+
+    with monitor.stage('load'):
+        try:
+            import biom
+            biom_table = biom.Table(table.counts.astype(np.float64), table.features.astype(str).to_list(),
+                                    table.samples.astype(str).to_list())
+            table = SparseFeatureTable.from_biom(biom_table)
+        except ImportError:
+            table = SparseFeatureTable(table.counts, table.features, table.samples)
+
+    with monitor.stage('group'):
+        mapping = treatment_mapping(metadata, 'treatment', treatments)
+        grouped, labels = group_sum(table, mapping, treatments)
+
+    with monitor.stage('split'):
+        split_replicates(table, mapping, treatments)
+
+    # The top N and 'Other' rows come from the summarizer's own formatter helpers
+    with monitor.stage('top_n'):
+        feature_labels = table.features.astype(str).to_numpy()
+        top_taxa_df, raw_asv_strings = summarizer.biime_top_taxa(grouped, labels, feature_labels, num)
+
+    outputdir = os.path.join(workdir, f'{n_features}x{n_samples}', '')
+    os.makedirs(outputdir, exist_ok=True)
+    if render:
+        with monitor.stage('render'):
+            summarizer.visualizer(top_taxa_df.T, 'benchmark', outputdir)
+            plt.close('all')
+
+        with monitor.stage('write'):
+            summarizer.stats_generator(top_taxa_df.copy(), outputdir, 'benchmark', raw_asv_strings)
+
+    tsv_path = write_biom_tsv(table, os.path.join(workdir, f'{n_features}x{n_samples}.txt'))
+    with monitor.stage('stream_group'):
+        streamed = group_biom_tsv(BiomTsv(tsv_path), mapping, treatments)
+    os.remove(tsv_path)
+
+    with monitor.stage('stream_top_n'):
+        summarizer.borneman_top_taxa(streamed, num)
+
+    return [{'features': n_features, 'samples': n_samples, 'treatments': n_treatments, 'top_n': num,
+             'density': density, 'stage': stage, **result}
+            for stage, result in monitor.results.items()]
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(base_file, new_file, threshold):
+    # Print new/base wall time per case and stage, exit 1 on any regression past the threshold
+    with open(base_file) as f:
+        base = pd.DataFrame(json.load(f)['runs'])
+    with open(new_file) as f:
+        new = pd.DataFrame(json.load(f)['runs'])
+
+    keys = ['features', 'samples', 'treatments', 'top_n', 'density', 'stage']
+    merged = base.merge(new, on=keys, suffixes=('_base', '_new'))
+    merged['time_ratio'] = merged['seconds_new'] / merged['seconds_base']
+    merged['rss_ratio'] = merged['peak_rss_mb_new'] / merged['peak_rss_mb_base']
+    print(merged[keys + ['seconds_base', 'seconds_new', 'time_ratio', 'rss_ratio']].to_markdown(index=False))
+
+    regressions = merged[merged['time_ratio'] > threshold]
+    if not regressions.empty:
+        print(f"\n{len(regressions)} stage(s) slower than {threshold}x the base run")
+        exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(add_help=False, prog="benchmark-taxa-summarizer.py", description="Benchmark the taxa summarizer hot paths on synthetic data")
+    parser.add_argument('-f', "--features", nargs='+', type=int, default=[100, 1000, 10000, 100000], help="Feature counts to benchmark (Default is 100 1000 10000 100000)")
+    parser.add_argument('-s', "--samples", nargs='+', type=int, default=[10, 100, 1000, 10000], help="Sample counts to benchmark (Default is 10 100 1000 10000, the largest cases write a biom txt of several GB)")
+    parser.add_argument('-t', "--treatments", type=int, default=8, help="Number of treatments (Default is 8)")
+    parser.add_argument('-n', "--top-n-taxa", type=int, default=20, help="Top N taxa to select (Default is 20)")
+    parser.add_argument("--density", type=float, default=0.05, help="Fraction of nonzero counts (Default is 0.05)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (Default is 0)")
+    parser.add_argument("--skip-render", action="store_true", help="Skip the render/write stages")
+    parser.add_argument('-o', "--output", help="JSON file to write results to", type=str)
+    parser.add_argument("--compare", nargs=2, metavar=('BASE', 'NEW'), help="Compare two result files instead of running")
+    parser.add_argument("--threshold", type=float, default=1.2, help="Time ratio counted as a regression when comparing (Default is 1.2)")
+    parser.add_argument('-h', '--help', action='help', default=argparse.SUPPRESS, help='Display commands possible with this program.')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.compare[0], args.compare[1], args.threshold)
+        exit(0)
+
+    # The grouped tables go through the summarizer's own top N/'Other' code, so it is always loaded (needs qiime2)
+    summarizer = load_summarizer()
+
+    runs = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for n_features in args.features:
+            for n_samples in args.samples:
+                print(f"Benchmarking {n_features} features x {n_samples} samples...")
+                runs.extend(run_case(n_features, n_samples, args.treatments, args.top_n_taxa,
+                                     args.density, args.seed, summarizer, workdir, not args.skip_render))
+
+    results = {'commit': git_commit(),
+               'date': datetime.now().isoformat(timespec='seconds'),
+               'python': platform.python_version(),
+               'numpy': np.__version__,
+               'pandas': pd.__version__,
+               'runs': runs}
+
+    print(pd.DataFrame(runs).to_markdown(index=False))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
@@ -0,0 +1,67 @@
+import importlib.util
+import os
+import sys
+
+# Run from anywhere, the shared helpers live one level up
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import numpy as np
+import pandas as pd
+import pytest
+from skbio import DistanceMatrix
+from skbio.stats.distance import permanova as skbio_permanova
+
+from microbio_tools.distance import braycurtis
+from microbio_tools.ordination import ordinate
+from microbio_tools.synthetic import synthetic_metadata, synthetic_table
+
+
+def load_script(name: str):
+    # The generators are scripts (dashes in the name), load them like a module
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), os.path.join(REPO_DIR, f'{name}.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_ordinate_leaves_the_distances_untouched(dtype, tmp_path):
+    table = synthetic_table(300, 40, density=0.05, seed=3)
+    ids = [str(sample) for sample in table.samples]
+    path = str(tmp_path / 'braycurtis_distance_matrix.npy')
+    np.save(path, braycurtis(table.counts, dtype))
+    distances = np.load(path, mmap_mode='r+')
+    expected = np.array(distances)
+    ordinate(distances, ids=ids)
+    ordinate(distances, 3, ids=ids)
+    np.testing.assert_array_equal(distances, expected)
+    np.testing.assert_array_equal(np.load(path), expected)
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_beta_diversity_matches_skbio(dtype, tmp_path):
+    qiime2 = pytest.importorskip('qiime2')
+    biom = pytest.importorskip('biom')
+    beta = load_script('beta-diversity-generator')
+
+    table = synthetic_table(500, 60, density=0.05, seed=4)
+    ids = [str(sample) for sample in table.samples]
+    frame = synthetic_metadata(ids, 3, seed=4)
+    artifact = qiime2.Artifact.import_data('FeatureTable[Frequency]',
+                                           biom.Table(table.counts, table.features.astype(str), ids))
+    treatments = sorted(frame['treatment'].unique())
+    output = f'{tmp_path}/'
+
+    beta.beta_diversity(artifact, qiime2.Metadata(frame), 'treatment', [','.join(treatments)], 'test', False,
+                        output, ['csv'], dtype=dtype, workers=2, permutations=99, tests=['permanova'])
+
+    # The saved matrix is the plain Bray-Curtis matrix, not the centered PCoA input
+    expected = DistanceMatrix(braycurtis(table.counts, np.float64), ids=ids)
+    saved = np.load(f'{output}braycurtis_distance_matrix.npy')
+    assert saved.dtype == dtype
+    np.testing.assert_allclose(saved, expected.data, atol=1e-6)
+
+    results = pd.read_csv(f'{output}significance_test_results.csv', index_col=0)
+    reference = skbio_permanova(expected, frame['treatment'], permutations=0)
+    assert results.loc['permanova', 'Statistic'] == pytest.approx(reference['test statistic'], abs=1e-5)
@@ -0,0 +1,52 @@
+import os
+import sys
+
+# Run from anywhere, the shared helpers live one level up
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import numpy as np
+import pytest
+from scipy.spatial.distance import pdist, squareform
+from skbio import DistanceMatrix
+
+from microbio_tools.distance import (METRICS, PSEUDOCOUNT, SampleMatrix, distance_matrices, save_feature_state,
+                                     save_sample_ids, update_distances)
+from microbio_tools.synthetic import synthetic_table
+
+
+def expected_distances(counts, metric: str) -> np.ndarray:
+    # The same metric from scipy on the dense samples x features counts
+    dense = counts.T.toarray().astype(np.float64)
+    if metric == 'aitchison':
+        logs = np.log(dense + PSEUDOCOUNT)
+        return squareform(pdist(logs - logs.mean(axis=1, keepdims=True), 'euclidean'))
+    if metric == 'jaccard':
+        dense = dense > 0
+    return squareform(np.nan_to_num(pdist(dense, metric)))
+
+
+@pytest.mark.parametrize('metric', METRICS)
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_distances_are_valid_skbio_matrices(metric, dtype):
+    table = synthetic_table(300, 70, density=0.05, seed=1)
+    distances = distance_matrices(SampleMatrix(table.counts), [metric], dtype, block_size=16)[metric]
+    # DistanceMatrix rejects anything that is not exactly hollow and symmetric
+    DistanceMatrix(distances, ids=[str(sample) for sample in table.samples])
+    np.testing.assert_allclose(distances, expected_distances(table.counts, metric), atol=1e-5)
+
+
+@pytest.mark.parametrize('metric', METRICS)
+def test_updated_distances_match_a_full_run(metric, tmp_path):
+    table = synthetic_table(300, 70, density=0.05, seed=2)
+    samples = [str(sample) for sample in table.samples]
+    features = [str(feature) for feature in table.features]
+    path = str(tmp_path / f'{metric}.npy')
+    distance_matrices(SampleMatrix(table.counts[:, :50]), [metric], np.float64, paths={metric: path})
+    save_sample_ids(path, samples[:50])
+    save_feature_state(path, metric, table.counts[:, :50], features)
+
+    updated, updated_samples = update_distances(path, metric, table.counts, features, samples, block_size=8)
+    assert updated_samples == samples
+    DistanceMatrix(np.asarray(updated), ids=updated_samples)
+    np.testing.assert_allclose(updated, expected_distances(table.counts, metric), atol=1e-8)
@@ -0,0 +1,45 @@
+import os
+import sys
+
+# Run from anywhere, the shared helpers live one level up
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from microbio_tools.grouping import group_biom_tsv, group_frame
+from microbio_tools.loaders import BiomTsv
+from microbio_tools.synthetic import synthetic_table, write_biom_tsv
+
+
+def dense_groups(path: str, mapping: pd.Series, treatments: list) -> pd.DataFrame:
+    # What the formatter does with a biom txt table it reads in one go
+    table = pd.read_table(path, sep='\t', skiprows=1).set_index('#OTU ID')
+    table.index.name = None
+    return group_frame(table, mapping, treatments)
+
+
+@pytest.mark.parametrize('relative', [False, True])
+def test_streamed_groups_match_the_dense_table(relative, tmp_path):
+    table = synthetic_table(250, 12, density=0.2, seed=5)
+    samples = table.samples.astype(str).to_list()
+    path = write_biom_tsv(table, str(tmp_path / 'table.txt'))
+    if relative:
+        # A relative frequency export, every sample sums to 1
+        frame = pd.read_table(path, sep='\t', skiprows=1, index_col=0)
+        frame = frame / frame.sum(axis=0)
+        with open(path, 'w') as f:
+            f.write('# Constructed from biom file\n')
+            frame.to_csv(f, sep='\t')
+    mapping = pd.Series(['A', 'B'] * 6, index=samples)
+
+    streamed = group_biom_tsv(BiomTsv(path, chunksize=40), mapping, ['A', 'B'])
+    expected = dense_groups(path, mapping, ['A', 'B'])
+    np.testing.assert_allclose(streamed.to_numpy(), expected.to_numpy())
+    assert (streamed.index == expected.index).all()
+    if relative:
+        np.testing.assert_allclose(streamed.sum(axis=0), [6, 6])
+    else:
+        assert streamed.to_numpy().dtype.kind == 'i'
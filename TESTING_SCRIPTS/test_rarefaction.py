@@ -0,0 +1,42 @@
+import os
+import sys
+
+# Run from anywhere, the shared helpers live one level up
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from microbio_tools.alpha import alpha_metrics
+from microbio_tools.rarefaction import rarefaction
+
+
+def test_undefined_metric_stays_nan_at_depth_one():
+    # A single read leaves a single taxon, so pielou_e is undefined for every draw
+    counts = sp.csc_matrix(np.array([[5, 1, 3, 0], [2, 4, 3, 6], [1, 0, 3, 2]]))
+    samples = ['s0', 's1', 's2', 's3']
+    mapping = pd.Series(['A', 'A', 'B', 'B'], index=samples)
+    curves, summary = rarefaction(counts, samples, [1], ['pielou_e', 'shannon'], mapping, ['A', 'B'],
+                                  iterations=5, workers=1)
+
+    evenness = summary[summary['metric'] == 'pielou_e']
+    assert evenness[['mean', 'ci low', 'ci high']].isna().all().all()
+    assert (evenness['samples'] == 2).all()
+    shannon = summary[summary['metric'] == 'shannon']
+    assert (shannon['mean'] == 0).all()
+    assert curves.loc[curves['metric'] == 'pielou_e', 'mean'].isna().all()
+
+
+def test_group_mean_skips_undefined_samples():
+    # Every sample holds exactly `depth` reads, so each draw is the sample itself.
+    # s1 and s3 have a single taxon, the group means only average the others.
+    counts = sp.csc_matrix(np.array([[4, 6, 2, 0], [2, 0, 2, 6], [0, 0, 2, 0]]))
+    samples = ['s0', 's1', 's2', 's3']
+    mapping = pd.Series(['A', 'A', 'B', 'B'], index=samples)
+    _, summary = rarefaction(counts, samples, [6], ['pielou_e'], mapping, ['A', 'B'], iterations=3, workers=1)
+
+    expected = alpha_metrics(counts, ['pielou_e'])['pielou_evenness']
+    np.testing.assert_allclose(summary['mean'], [expected[0], expected[2]])
+    np.testing.assert_allclose(summary['ci low'], summary['mean'])
@@ -0,0 +1,64 @@
+import os
+import sys
+
+# Run from anywhere, the shared helpers live one level up
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse as sp
+
+from microbio_tools.selection import AMBIGUOUS_TAXA, top_n_taxa, top_n_taxa_sparse
+
+
+def original_top_n_taxa(merged_data: pd.DataFrame, num: int, filter_for_list=None) -> list:
+    # The round robin loop the formatters used before microbio_tools.selection,
+    # re-sorting the table for every treatment on every row
+    counter = 0
+    curr_row = 0
+    treatments = merged_data.columns.to_list()
+    top_n_taxa = []
+    filter_for_list = filter_for_list or []
+    while (counter < num):
+        for i in range(len(treatments)):
+            sorted_table = merged_data.sort_values(by=f'{treatments[i]}', ascending=False)
+            taxa = sorted_table.iloc[curr_row].name
+            if taxa not in top_n_taxa and taxa not in filter_for_list:
+                top_n_taxa.append(taxa)
+                counter += 1
+            if counter >= num:
+                break
+        curr_row += 1
+    return top_n_taxa
+
+
+def abundance_table(kind: str, seed: int, n_features: int = 400, n_columns: int = 12) -> pd.DataFrame:
+    # 'ties': small counts, nearly every value tied. 'tail': sparse long tailed counts.
+    rng = np.random.default_rng(seed)
+    if kind == 'ties':
+        values = rng.integers(0, 3, (n_features, n_columns))
+    else:
+        values = np.floor(rng.lognormal(0, 2, (n_features, n_columns)) * (rng.random((n_features, n_columns)) < 0.3))
+    index = [f'feature{i}' for i in range(n_features)]
+    # A few ambiguous lineages so the filter has something to skip
+    index[:len(AMBIGUOUS_TAXA)] = AMBIGUOUS_TAXA
+    return pd.DataFrame(values.astype(np.float64), index=index, columns=[f'T{j}' for j in range(n_columns)])
+
+
+@pytest.mark.parametrize('kind', ['ties', 'tail'])
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('exclude', [None, AMBIGUOUS_TAXA])
+def test_dense_matches_original_loop(kind, seed, exclude):
+    table = abundance_table(kind, seed)
+    assert top_n_taxa(table, 50, exclude) == original_top_n_taxa(table, 50, exclude)
+
+
+@pytest.mark.parametrize('kind', ['ties', 'tail'])
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('exclude', [None, AMBIGUOUS_TAXA])
+def test_sparse_matches_original_loop(kind, seed, exclude):
+    table = abundance_table(kind, seed)
+    positions = top_n_taxa_sparse(sp.csr_matrix(table.to_numpy().astype(np.int64)), table.index, 50, exclude)
+    assert table.index[positions].to_list() == original_top_n_taxa(table, 50, exclude)
@@ -1,112 +1,66 @@
 # Python imports
 import argparse
-import json
 import os
 from datetime import datetime
 import re
 
+import matplotlib
+#Figures are only saved to disk (from forked workers), force a non-interactive backend
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
-import scipy.stats as stats
 from qiime2 import Artifact, Metadata
 
 # Qiime2 imports
 from qiime2.plugins import diversity, feature_table
 
+from microbio_tools.alpha import METRIC_COLUMNS, METRIC_LABELS, alpha_long_table, alpha_table, metric_suffix
+from microbio_tools.batch import run_jobs
+from microbio_tools.colors import load_or_create_color_map
+from microbio_tools.grouping import report_missing, treatment_mapping
+from microbio_tools.loaders import SparseFeatureTable
+from microbio_tools.plotting import grouped_boxes
+from microbio_tools.rarefaction import rarefaction, rarefaction_depths
+from microbio_tools.significance import POSTHOC_METHODS, significance_tests
+from microbio_tools.writers import OUTPUT_FORMATS, TABLE_FORMATS, parse_formats, write_outputs
 
 
-def significance(dataframe, outputdir):
-    #https://stackoverflow.com/questions/15943769/how-do-i-get-the-row-count-of-a-pandas-dataframe 
-    n = dataframe[dataframe.columns[0]].count()
-    dataframe_list=[]
-    #Here we just find the statsical signifcance between treatments 
-    #The algorithm isn't the most efficent as it is O(n^2) but if we add parallization then we 
-    #can probably reduce the time spent calculating when using larger datasets
-    for i in range(n-1):
-        current_treatment = dataframe.iloc[i].item()
-        print(f'curr={current_treatment}')
-        current_treatment_name = dataframe.index[i]
-        grouping=[]
-        for j in range(i+1, n):
-            jth_treatment = dataframe.iloc[j].item()
-            print(f'jth={jth_treatment}')
-            jth_treatment_name = dataframe.index[j]
-            kruskal_test= stats.kruskal(current_treatment, jth_treatment)
-            grouping.append((jth_treatment_name,kruskal_test[0][1], kruskal_test[1][1]))
-        temp_df=pd.DataFrame({'label, H value, P value': [grouping]}, index=[current_treatment_name])
-        temp_df.index.rename('Treatment',inplace=True)
-        #Append treatment dataframe to a list of dataframes
-        dataframe_list.append(temp_df)
-            
-    
-    #Concate each dataframe from the data frame list by columns
-    signifcance_table=pd.concat(dataframe_list, axis=0, join='outer')
-    print(signifcance_table)
-    return signifcance_table
-
-def load_or_create_color_map(headers, outputdir):
-    color_file = os.path.join(outputdir, 'color_map.json')
-
-    color_map = {}
-    if os.path.exists(color_file):
-        print("Loading existing color map...")
-        with open(color_file, 'r') as f:
-            color_map = json.load(f)
-
-    cmap = plt.get_cmap('tab20')
-    all_colors = [cmap(i) for i in range(cmap.N)]
-
-    color_index = len(color_map)
 
-    for taxon in headers:
-        if taxon not in color_map:
-            if color_index >= len(all_colors):
-                print(f"Warning: Not enough colors for all taxons, reusing colors")
-                color_index = color_index % len(all_colors)
+def significance(dataframe, outputdir, method='dunn', workers=None):
+    #One omnibus Kruskal-Wallis test across every treatment, then posthoc tests on all
+    #treatment pairs at once with FDR corrected p values (see microbio_tools.significance)
+    omnibus, pairs = significance_tests(dataframe, method=method, workers=workers)
+    print(omnibus)
+    print(pairs)
+    return omnibus, pairs
 
-            color_map[taxon] = all_colors[color_index]
-            color_index += 1
-
-    with open(color_file, 'w') as f:
-        json.dump(color_map, f, indent=None, separators=(',', ':'))
-
-    print("Color map loaded successfully")
-
-    return color_map
-
-def visualizer(dataframe, plot_title, outputdir):
-    cmap = plt.get_cmap('tab20')
+def visualizer(dataframe, plot_title, outputdir, metric='shannon'):
     fig, ax = plt.subplots(figsize = (15, 10))
     medianprops = dict(linestyle='-', linewidth=1.5, color='black')
    
-    data = dataframe.drop(columns=['labeled-scores'])
-
-    types = [match.group(1) for s in data.index if (match := re.search(r'^(T\d+)', s))]
-    color_map = load_or_create_color_map(types, outputdir)
-
-    for i, row in enumerate(data.iterrows()):
-        scores = row[1]['raw-scores']
-
-        color_key = re.search(r'^(T\d+)', row[0])
-        if not color_key:
-            print(f"Warning: No color key found for {row[0]}")
-            continue
-        color = color_map[color_key.group(1)]
-
-        hatch = '//' if 'm154' in row[0] else ''
-
-        boxprops = dict(facecolor=color, hatch=hatch)
-        flierprops = dict(marker='o',
-                          markerfacecolor=color,
-                          markersize=8)
-        plt.boxplot(scores,
-                    labels=[row[0]],
-                    positions=[i],
-                    patch_artist=True,
-                    boxprops=boxprops,
-                    medianprops=medianprops,
-                    flierprops=flierprops,
-                    widths=0.7)
+    #Scores of every treatment from the long (samples, treatment, value) table
+    data = dataframe.groupby('treatment', observed=False, sort=True)['value']
+    names = pd.Series(list(data.groups), dtype=str)
+
+    #Color keys and hatching for every treatment at once
+    color_keys = names.str.extract(r'^(T\d+)', expand=False)
+    color_map = load_or_create_color_map(color_keys.dropna().tolist(), outputdir)
+    for treatment in names[color_keys.isna()]:
+        print(f"Warning: No color key found for {treatment}")
+    keep = color_keys.notna().to_numpy()
+
+    #Empty treatments still get a (flat) box, like before
+    # *Undefined (NaN) scores, i.e. pielou_e of a single taxon sample, are left out
+    scores = [values.dropna().to_numpy() for _, values in data]
+    scores = [values if len(values) else np.zeros(1) for values in scores]
+    grouped_boxes(ax,
+                  [group for group, kept in zip(scores, keep) if kept],
+                  names[keep].tolist(),
+                  [color_map[key] for key in color_keys[keep]],
+                  np.where(names[keep].str.contains('m154'), '//', '').tolist(),
+                  positions=np.flatnonzero(keep),
+                  medianprops=medianprops)
 
     plt.xticks(rotation=90,fontsize='13')
     plt.yticks(fontsize='13')
@@ -114,112 +68,167 @@ def visualizer(dataframe, plot_title, outputdir):
     #https://stackoverflow.com/questions/52273543/creating-multiple-boxplots-on-the-same-graph-from-a-dictionary
     #https://matplotlib.org/stable/gallery/statistics/boxplot.html#sphx-glr-gallery-statistics-boxplot-py
     #https://stackoverflow.com/questions/32443803/adjust-width-of-box-in-boxplot-in-python-matplotlib
-    plt.ylabel('Shannon Diversity', fontsize='15') 
-    plt.title(f'{plot_tilte}', fontsize='20') 
+    plt.ylabel(METRIC_LABELS[metric], fontsize='15') 
+    plt.title(f'{plot_title}', fontsize='20') 
     ax.spines['top'].set_visible(False)
     ax.spines['right'].set_visible(False)
     plt.tight_layout()
-    fig.savefig(f"{output}alpha_plot.png", dpi=300)
+    fig.savefig(f"{outputdir}alpha_plot{metric_suffix(metric)}.png", dpi=300)
+    plt.close(fig)
 
-def stats_generator(stats, outputdir):
-    
-    dataframe = stats.drop(columns=['raw-scores'])
+def render_plot(job):
+    visualizer(*job)
 
-    datatframe_stats = significance(dataframe, outputdir) 
-    #Saving them to an execel file
-    print('Generating excel file...')
-    dataframe.to_excel(f'{output}alpha_diversity_stats.xlsx')
 
-    print('Generating markdown file with table stats...')
+def stats_generator(stats, outputdir, formats=None, metric='shannon', posthoc='dunn', workers=None):
+    
+    dataframe = stats.set_index('samples')
+
+    omnibus_stats, datatframe_stats = significance(stats, outputdir, posthoc, workers) 
     time_generated=datetime.now().strftime("%d/%m/%y %H:%M:%S")
-    with open(f'{output}alpha_diversity_stats.md', "w") as f:
-        f.write(f'''#Alpha diversity stats\n
+
+    def markdown():
+        return f'''#Alpha diversity stats ({METRIC_LABELS[metric]})\n
                 ## To find further sequence specific information, refer to table 03 generated previously\n
                 **Please refer to the excel or csv file generated to perform further analysis.**\n
                 Date file was generated: {time_generated}\n
                 {dataframe.to_markdown()}\n
-                {datatframe_stats.to_markdown()}''')
-        
-    print('Generating html file with table stats...')
-    with open(f'{outputdir}alpha_diversity_stats.html', "w") as f:
-        f.write(f'''<!doctype html>
+                {omnibus_stats.to_markdown(index=False)}\n
+                {datatframe_stats.to_markdown(index=False)}'''
+
+    def html():
+        return f'''<!doctype html>
     <html lang="en">
         <head>
             <meta charset="utf-8">
             <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/css/bootstrap.min.css">
         </head>
         <body>
-            <h1>Alpha diversity stats</h1>
+            <h1>Alpha diversity stats ({METRIC_LABELS[metric]})</h1>
             <h2 >To find further sequence specific information, refer to table 03 generated previously.</h2>
             <strong>Please refer to the excel file generated to perform further analysis. </strong>
             <p>Date file was generated: {time_generated}</p>
             {dataframe.to_html()}
-            {datatframe_stats.to_html()}
-            ''')
+            {omnibus_stats.to_html(index=False)}
+            {datatframe_stats.to_html(index=False)}
+            '''
 
+    #Write every requested format at the same time
+    name = f'alpha_diversity_stats{metric_suffix(metric)}'
+    write_outputs(outputdir,
+                  {name: dataframe,
+                   f'alpha_diversity_omnibus{metric_suffix(metric)}': omnibus_stats.set_index('test'),
+                   f'alpha_diversity_pairs{metric_suffix(metric)}': datatframe_stats.set_index(['group 1', 'group 2'])},
+                  {'md': (f'{name}.md', markdown), 'html': (f'{name}.html', html)},
+                  formats)
 
-def alpha_diversity(asv_table, map_file, data_column, treatments, plot_title, outputdir):
+
+def alpha_diversity(asv_table, map_file, data_column, treatments, plot_title, outputdir, output_formats=None, use_qiime2=False, metrics=('shannon',), posthoc='dunn', workers=None):
     pd.options.mode.chained_assignment = None
     #Further resources can be found at the following links below:
     #https://develop.qiime2.org/en/latest/intro.html
     #https://docs.qiime2.org/2024.5/plugins/
     
-    #Filter feature table to only contain samples with a tag in the given column
-    asv_table_filtered= feature_table.methods.filter_samples(table=asv_table, metadata=map_file, where=f"{data_column} NOT NULL")
-    asv_table_filtered = asv_table_filtered.filtered_table
-    
-    #Calculate the alpha diversity of each sample 
-    alpha_results = diversity.pipelines.alpha(table=asv_table_filtered, metric='shannon')
-    alpha_diversity_table = alpha_results.alpha_diversity
-    alpha_diversity_table = pd.DataFrame(alpha_diversity_table.view(pd.Series))
-    alpha_diversity_table.index.rename('samples',inplace=True)
+    if use_qiime2 == True:
+        #Filter feature table to only contain samples with a tag in the given column
+        asv_table_filtered= feature_table.methods.filter_samples(table=asv_table, metadata=map_file, where=f"{data_column} NOT NULL")
+        asv_table_filtered = asv_table_filtered.filtered_table
+        
+        #Calculate the alpha diversity of each sample (Slower, but keeps qiime 2 provenance)
+        alpha_list=[]
+        for metric in metrics:
+            alpha_results = diversity.pipelines.alpha(table=asv_table_filtered, metric=metric)
+            alpha_list.append(alpha_results.alpha_diversity.view(pd.Series))
+        alpha_diversity_table = pd.concat(alpha_list, axis=1)
+        alpha_diversity_table.index.rename('samples',inplace=True)
+    else:
+        #Calculate every alpha metric of each sample with a tag in the given column in one pass
+        # *Computed straight from the sparse count matrix, no intermediate qiime 2 artifacts
+        tagged_samples = map_file.get_column(f"{data_column}").drop_missing_values().ids
+        alpha_diversity_table = alpha_table(SparseFeatureTable.from_artifact(asv_table), metrics, tagged_samples)
     treatments=treatments[0].split(',')
     print('Treatments to be processed...')
     for i in range(len(treatments)):
         print(treatments[i], end='\t')
-    n = len(treatments)
-    dataframe_list=[]
-    all_samples=alpha_diversity_table.index.to_list()
+
     #Here we are mapping treatments and samples together for data visualization and parsing later on 
-    for i in range(n):
-        #Get the current treatment
-        current_treatment=treatments[i]
-
-        #Extract the samples from map file that are labeled with the current treatement
-        # *Uses qiime 2 Metdata function 'get_ids' to extract all samples from a treatment based on the map file 
-        samples = list(map_file.get_ids(f"[{data_column}]='{current_treatment}'"))
-        #Here we will go through each sample and find its corresponding alpha diversity value
-        alpha_diversity_score=[]
-        raw_scores=[]
-        for sample in samples:
-            if sample not in all_samples:
-                print(f"{sample} is not in the ASV table, please check raw counts file for this sequence run")
-            else:
-                a_score = (sample,alpha_diversity_table.loc[sample,'shannon_entropy'])
-                r_score = alpha_diversity_table.loc[sample,'shannon_entropy']
-                alpha_diversity_score.append(a_score)
-                raw_scores.append(r_score)
-
-        #https://stackoverflow.com/questions/9376384/sort-a-list-of-tuples-depending-on-two-elements
-        #Here we sort the labeled score by their shaonnon score, this is really just for easing viewing 
-        if len(alpha_diversity_score) > 0:
-            alpha_diversity_score=sorted(alpha_diversity_score, key=lambda scores: scores[-1])
-        else:
-            alpha_diversity_score.append(0)
-            raw_scores.append(0)
-        temp_df=pd.DataFrame({'labeled-scores':[alpha_diversity_score], 'raw-scores': [raw_scores]}, index=[current_treatment])
-        temp_df.index.rename('treatment',inplace=True)
-        #Append treatment dataframe to a list of dataframes
-        dataframe_list.append(temp_df)
-            
-    
-    #Concate each dataframe from the data frame list by columns
-    asv_table_filtered=pd.concat(dataframe_list, axis=0, join='outer')
+    # *One join between the map file column and the alpha scores, missing samples come from a set difference
+    mapping = treatment_mapping(map_file, data_column, treatments)
+    mapping = report_missing(mapping, alpha_diversity_table.index)
+    long_table = alpha_long_table(alpha_diversity_table, mapping, metrics, treatments)
 
     print("Merged, grouped, and filtered down table...")
-    print(asv_table_filtered)
-    visualizer(asv_table_filtered, plot_title, outputdir)
-    stats_generator(asv_table_filtered, outputdir)
+    print(long_table)
+    tidy_formats=[f for f in parse_formats(output_formats) if f in TABLE_FORMATS] or ['csv']
+    write_outputs(outputdir, {'alpha_metrics': long_table}, {}, tidy_formats)
+
+    metric_tables = {metric: long_table[long_table['metric'] == metric].drop(columns=['metric']) for metric in metrics}
+    for metric in metrics:
+        stats_generator(metric_tables[metric], outputdir, output_formats, metric, posthoc, workers)
+
+    #Figures are rendered on at most one worker process per metric, a single figure in process
+    # *The colors are registered once up front so the workers only read them
+    color_keys = long_table['treatment'].astype(str).str.extract(r'^(T\d+)', expand=False)
+    load_or_create_color_map(color_keys.dropna().unique().tolist(), outputdir)
+    jobs = [(metric_tables[metric], plot_title, outputdir, metric) for metric in metrics]
+    run_jobs(jobs, render_plot, min(len(jobs), workers or os.cpu_count() or 1))
+
+
+def rarefaction_visualizer(summary, plot_title, outputdir, metric='shannon'):
+    #Mean of every treatment at each depth with its interval shaded around the line
+    fig, ax = plt.subplots(figsize = (15, 10))
+    data = summary[summary['metric'] == metric]
+
+    types = [match.group(1) for s in data['treatment'].unique() if (match := re.search(r'^(T\d+)', s))]
+    color_map = load_or_create_color_map(types, outputdir)
+
+    for treatment, curve in data.groupby('treatment', sort=False):
+        color_key = re.search(r'^(T\d+)', treatment)
+        color = color_map[color_key.group(1)] if color_key else None
+        linestyle = '--' if 'm154' in treatment else '-'
+        lines = ax.plot(curve['depth'], curve['mean'], label=treatment, color=color, linestyle=linestyle, marker='o')
+        ax.fill_between(curve['depth'], curve['ci low'], curve['ci high'], color=lines[0].get_color(), alpha=0.2)
+
+    plt.xticks(fontsize='13')
+    plt.yticks(fontsize='13')
+    plt.xlabel('Sequencing Depth', fontsize='15')
+    plt.ylabel(METRIC_LABELS[metric], fontsize='15')
+    plt.title(f'{plot_title}', fontsize='20')
+    ax.legend(bbox_to_anchor=(1.01, 1), loc='upper left', fontsize='13')
+    ax.spines['top'].set_visible(False)
+    ax.spines['right'].set_visible(False)
+    plt.tight_layout()
+    fig.savefig(f"{outputdir}alpha_rarefaction{metric_suffix(metric)}.png", dpi=300)
+    plt.close(fig)
+
+
+def alpha_rarefaction(asv_table, map_file, data_column, treatments, plot_title, outputdir, max_depth, steps=10, iterations=10, seed=0, output_formats=None, metrics=('shannon',), workers=None):
+    #Repeated rarefaction of every sample with a tag in the given column so alpha
+    #diversity can be compared between samples sequenced at very different depths
+    treatments=treatments[0].split(',')
+    table = SparseFeatureTable.from_artifact(asv_table)
+    tagged_samples = map_file.get_column(f"{data_column}").drop_missing_values().ids
+    positions, _ = table.sample_positions(tagged_samples)
+    counts = table.counts[:, positions]
+    samples = table.samples.astype(str)[positions]
+
+    mapping = treatment_mapping(map_file, data_column, treatments)
+    mapping = report_missing(mapping, samples)
+
+    totals = np.asarray(counts.sum(axis=0)).ravel()
+    depths = rarefaction_depths(totals, max_depth, steps)
+    print(f"Rarefying {len(samples)} samples at {len(depths)} depths ({iterations} iterations each)...")
+    curves, summary = rarefaction(counts, samples, depths, metrics, mapping, treatments,
+                                  iterations=iterations, seed=seed, workers=workers)
+    print(summary)
+
+    tidy_formats=[f for f in parse_formats(output_formats) if f in TABLE_FORMATS] or ['csv']
+    write_outputs(outputdir,
+                  {'alpha_rarefaction': summary.set_index(['depth', 'treatment', 'metric']),
+                   'alpha_rarefaction_samples': curves.set_index(['depth', 'samples', 'metric'])},
+                  {}, tidy_formats)
+    for metric in metrics:
+        rarefaction_visualizer(summary, plot_title, outputdir, metric)
 
 
 def validate_data(asv_table) -> None:
@@ -240,6 +249,15 @@ if __name__ == '__main__':
     parser.add_argument('-p', "--plot-title", help="Tilte for plot",type=str)
     parser.add_argument('-l', "--listing", nargs='+', type=str, help="Set a preferred listing for x axis (Default is nothing)")
     parser.add_argument('-d', "--output-dir", required=True, help="Output directory location",type=str)
+    parser.add_argument("--metrics", nargs='+', type=str, default=['shannon'], help=f"Alpha metrics to compute ({', '.join(METRIC_COLUMNS)}), Default is shannon")
+    parser.add_argument("--qiime2-alpha", action="store_true", help="Use the qiime 2 alpha pipeline (keeps provenance, slower)")
+    parser.add_argument("--posthoc", type=str, default='dunn', choices=POSTHOC_METHODS, help="Pairwise test run after the omnibus Kruskal-Wallis test, Default is dunn")
+    parser.add_argument('-w', "--workers", type=int, help="Processes used for rarefaction depths and very large numbers of treatment pairs (Default is every CPU)")
+    parser.add_argument("--rarefaction-depth", type=int, help="Also draw rarefaction curves up to this sequencing depth")
+    parser.add_argument("--rarefaction-steps", type=int, default=10, help="Number of depths between 1 and the rarefaction depth, Default is 10")
+    parser.add_argument("--rarefaction-iterations", type=int, default=10, help="Subsamples drawn at every depth, Default is 10")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the rarefaction subsamples, Default is 0")
+    parser.add_argument("--output-formats", nargs='+', type=str, help=f"Stats file formats to write ({', '.join(OUTPUT_FORMATS)}), Default is xlsx md html")
     parser.add_argument('-h', '--help', action='help', default=argparse.SUPPRESS, help='Display commands possible with this program.')
     args = parser.parse_args()
 
@@ -249,11 +267,21 @@ if __name__ == '__main__':
     plot_tilte=args.plot_title
     treatments=args.listing
     output=os.path.join(args.output_dir, "alpha-output/")
+    use_qiime2=args.qiime2_alpha
+    metrics=list(dict.fromkeys(','.join(args.metrics).split(',')))
+    if any(metric not in METRIC_COLUMNS for metric in metrics):
+        parser.error(f"Unknown alpha metric, choose from {', '.join(METRIC_COLUMNS)}")
+    try:
+        output_formats=parse_formats(args.output_formats)
+    except ValueError as e:
+        parser.error(str(e))
 
     if ((asv_table := validate_data(data_file)) != None) and ((map_file := Metadata.load(map_file)) != None):
         if not os.path.exists(output):
             os.mkdir(output)
-        alpha_diversity(asv_table,map_file,data_column,treatments,plot_tilte,output)
+        alpha_diversity(asv_table,map_file,data_column,treatments,plot_tilte,output,output_formats,use_qiime2,metrics,args.posthoc,args.workers)
+        if args.rarefaction_depth:
+            alpha_rarefaction(asv_table,map_file,data_column,treatments,plot_tilte,output,args.rarefaction_depth,args.rarefaction_steps,args.rarefaction_iterations,args.seed,output_formats,metrics,args.workers)
     else:
         print('Invalid data type or map file')
         exit(1)
@@ -2,7 +2,6 @@ import argparse
 from datetime import datetime
 import os
 from skbio import OrdinationResults, DistanceMatrix
-from skbio.stats.distance import permanova
 from qiime2.plugins import feature_table, diversity
 from qiime2 import Metadata, Artifact
 import matplotlib.pyplot as plt
@@ -11,286 +10,212 @@ import pandas as pd
 from collections import defaultdict
 import re
 
+from microbio_tools.cache import DistanceCache, content_hash
+from microbio_tools.colors import load_or_create_color_map
+from microbio_tools.distance import (METRICS, SampleMatrix, distance_matrices, load_feature_state,
+                                     save_feature_state, save_sample_ids, update_distances)
+from microbio_tools.grouping import report_missing, treatment_labels, treatment_mapping
+from microbio_tools.loaders import SparseFeatureTable
+from microbio_tools.ordination import axis_label, captured_variance, ordinate
+from microbio_tools.permanova import GROUP_TESTS, MAX_PERMUTATIONS, pairwise_permanova, permanova
+from microbio_tools.plotting import (DEFAULT_COLOR_PATTERN, DEFAULT_COLORS, DEFAULT_MARKER_PATTERN,
+                                     grouped_scatter, parse_style_map, treatment_styles)
+from microbio_tools.writers import OUTPUT_FORMATS, parse_formats, write_outputs
+
+
+def distance_data(distance_matrix, ids=None):
+    # (square array, sample ids) of a qiime2 distance matrix Artifact, a skbio
+    # DistanceMatrix, or an array (i.e. a float32 memmap) with its ids. Arrays are
+    # used as they are, without a float64 copy.
+    if isinstance(distance_matrix, np.ndarray):
+        return distance_matrix, [str(sample) for sample in ids]
+    # Convert Distance Matrix Qiime2 object to skbio Distance Matrix Object
+    if not isinstance(distance_matrix, DistanceMatrix):
+        distance_matrix = distance_matrix.view(DistanceMatrix)
+    return distance_matrix.data, list(distance_matrix.ids)
+
 
 def significance_test_non_pairwise(distance_matrix,
                      metadata,
-                     data_column) -> pd.DataFrame:
+                     data_column,
+                     treatments=None,
+                     permutations=None,
+                     seed=0,
+                     alpha=0.05,
+                     max_permutations=MAX_PERMUTATIONS,
+                     coordinates=None,
+                     tests=GROUP_TESTS,
+                     ids=None) -> pd.DataFrame:
     # Create empty dictionary to store results
     results_df = defaultdict(dict)
 
-
-
-    # Convert Distance Matrix Qiime2 object to skbio Distance Matrix Object
-    distance_matrix = distance_matrix.view(DistanceMatrix)
-
-    # Extract all sample ids in the current Distance Matrix
-    all_ids = list(distance_matrix.ids)
-
-
-    # Create a DataFrame object from filltered Distance Matrix object
-    dm_df = distance_matrix.to_data_frame()
-    dm_df.index.names = ['IDs']
-
-    # Filter metadata file to only include information about samples ids in the current distance martix
-    map_ids = metadata.get_column(f"{data_column}")
-    map_ids = map_ids.filter_ids(all_ids)
-    map_ids = map_ids.to_dataframe()
-    map_ids.index.names = ['IDs']
-
-    # Merge to both DataFrame objects into one dataframe
-    main_df = pd.merge(dm_df,
-                        map_ids,
-                        left_index=True,
-                        right_index=True)
-
-    results = permanova(distance_matrix,
-                    main_df,
-                    column=data_column,
-                    permutations=999)
-
-    results_df["Sample Size"] = int(results.get("sample size"))
-    results_df["Permutations"] = int(results.get("number of permutations"))
-    results_df["pseudo-F"] = round(results.get("test statistic"), 6)
-    results_df["p-value"] = round(results.get("p-value"), 3)
+    distances, ids = distance_data(distance_matrix, ids)
+
+    # Map every sample in the current Distance Matrix to its treatment once
+    column = treatment_labels(metadata.get_column(f"{data_column}").to_series())
+    if treatments is None:
+        treatments = sorted(column.reindex(ids).dropna().unique())
+    mapping = treatment_mapping(metadata, data_column, treatments)
+
+    # Adaptive permutations unless a fixed number is given
+    # *PERMANOVA, ANOSIM and PERMDISP are all scored on the same shuffled groupings
+    results = permanova(distances,
+                        ids,
+                        mapping,
+                        treatments,
+                        permutations=permutations,
+                        seed=seed,
+                        alpha=alpha,
+                        max_permutations=max_permutations,
+                        coordinates=coordinates,
+                        tests=tests)
+
+    for test, result in results.items():
+        results_df[test]["Sample Size"] = int(result.get("sample size"))
+        results_df[test]["Permutations"] = int(result.get("permutations"))
+        results_df[test]["Statistic"] = round(result.get("statistic"), 6)
+        results_df[test]["p-value"] = round(result.get("p-value"), 5)
 
 
     print(results_df)
     return pd.DataFrame.from_dict(results_df,
                                   orient='index',
-                                  columns=['Results'])
+                                  columns=["Sample Size", "Permutations", "Statistic", "p-value"])
 
 
          
 def significance_test_pairswise(distance_matrix,
                      metadata,
                      treatments,
-                     data_column) -> pd.DataFrame:
-
-    # Create empty dictionary to store results
-    results_df = defaultdict(dict)
-
-    # Convert Distance Matrix Qiime2 object to skbio Distance Matrix Object
-    distance_matrix = distance_matrix.view(DistanceMatrix)
-
-    # Extract all sample ids in the current Distance Matrix
-    all_ids = distance_matrix.ids
-
-    for i in range(len(treatments)):
-        # Set ith treatment
-        treatment_a = treatments[i]
-
-        # Get all samples from map file that relate to treatment_a
-        a_ids = map_file.get_ids(f"[{data_column}]='{treatment_a}'")
-        for j in range(i+1, len(treatments)):
-            # Set jth treatment
-            treatment_b = treatments[j]
-
-            # Get all samples from map file that relate to treatment_b
-            b_ids = map_file.get_ids(f"[{data_column}]='{treatment_b}'")
-
-
-            # Filter list to only include samples in the current DistanceMatrix object
-            temp_compare_ids = list(a_ids.union(b_ids))
-
-            compare_ids = []
-            for id in temp_compare_ids:
-                if id in all_ids:
-                    compare_ids.append(id)
-
-
-            # Filter DistanceMatrix to contain all samples to be compared against (I.E A Vs B)
-            filtered_dm = distance_matrix.filter(compare_ids)
-
-            # Create a DataFrame object from filltered DistanceMatrix object
-            dm_df = filtered_dm.to_data_frame()
-            dm_df.index.names = ['IDs']
-
-            # Create a DataFrame which maps IDs to treatments
-            map_ids = metadata.get_column(f"{data_column}")
-            map_ids = map_ids.filter_ids(compare_ids)
-            map_ids = map_ids.to_dataframe()
-            map_ids.index.names = ['IDs']
-
-
-            # Merge to DataFrames to finish mapping IDs to treatments
-            main_df = pd.merge(dm_df,
-                               map_ids,
-                               left_index=True,
-                               right_index=True)
-
-            results = permanova(filtered_dm,
-                                main_df,
-                                column=data_column,
-                                permutations=999)
-
-            # Map results to dictionary
-            results_df[f"{treatment_a}"][f"{treatment_b}"] = {
-                    "Sample size": results.get("sample size"),
-                    "Permutations": results.get("number of permutations"),
-                    "pseudo-F": round(results.get("test statistic"), 6),
-                    "p-value": round(results.get("p-value"), 3)
-                    }
-
-    return pd.DataFrame.from_dict(results_df, orient='index')
+                     data_column,
+                     permutations=None,
+                     seed=0,
+                     workers=None,
+                     alpha=0.05,
+                     max_permutations=MAX_PERMUTATIONS,
+                     coordinates=None,
+                     tests=GROUP_TESTS,
+                     ids=None) -> pd.DataFrame:
+
+    distances, ids = distance_data(distance_matrix, ids)
+
+    # Map every sample in the current Distance Matrix to its treatment once
+    mapping = treatment_mapping(metadata, data_column, treatments)
+
+    # Every pair indexes into the one (squared) distance matrix, pairs run on a process pool
+    results = pairwise_permanova(distances,
+                                 ids,
+                                 mapping,
+                                 treatments,
+                                 permutations=permutations,
+                                 seed=seed,
+                                 workers=workers,
+                                 alpha=alpha,
+                                 max_permutations=max_permutations,
+                                 coordinates=coordinates,
+                                 tests=tests)
+    results['statistic'] = results['statistic'].round(6)
+    results['p-value'] = results['p-value'].round(5)
+
+    print(results)
+    return results.set_index(['group 1', 'group 2', 'test'])
 
 
 
 # Generate statsics
 def stats_generator(stats,
                     output,
-                    sig_results) -> None:
+                    sig_results,
+                    formats=None,
+                    captured=1.0,
+                    metric='braycurtis') -> None:
     # Extract distance levels
     dists = stats.columns.to_list()
 
     # Drop all other levels and relabel columns
+    # *Numbered by position, qiime2 labels the axes 0.. and skbio PC1..
     dists_pts = stats.drop(columns=dists[5:])
-    renum = dists_pts.columns.to_list()
-    renum = [x + 1 for x in renum]
-    dists_pts.columns = renum
-
-    # Generate excel file filed with distance points/sig test
-    print('Generating excel file...')
-    dists_pts.to_excel(f'{output}beta_diversity_stats.xlsx')
-    sig_results.to_excel(f'{output}significance_test_results.xlsx')
+    dists_pts.columns = range(1, len(dists_pts.columns) + 1)
 
-    # Generate markdown file
-    print('Generating markdown file with table stats...')
     time_generated=datetime.now().strftime("%d/%m/%y %H:%M:%S")
-    with open(f'{output}beta_diversity_stats.md', "w") as f:
-        f.write(f'''#Beta diversity stats\n
+
+    # Markdown file
+    def markdown():
+        return f'''#Beta diversity stats ({metric})\n
                 ## To find further sequence specific information, refer to table 03 generated previously\n
                 **Please refer to the excel or csv file generated to perform further analysis.**\n
                 Date file was generated: {time_generated}\n
+                Variance captured by the computed axes: {captured:.2%}\n
                 ## Distance points
                 {dists_pts.to_markdown()}\n
-                ## PERMANOVA results
-                {sig_results.to_markdown()}''')
+                ## Group tests (PERMANOVA, ANOSIM, PERMDISP)
+                {sig_results.to_markdown()}'''
 
-    # Generate html file
-    print('Generating html file with table stats...')
-    with open(f'{output}beta_diversity_stats.html', "w") as f:
-        f.write(f'''<!doctype html>
+    # Html file
+    def html():
+        return f'''<!doctype html>
     <html lang="en">
         <head>
             <meta charset="utf-8">
             <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/css/bootstrap.min.css">
         </head>
         <body>
-            <h1>Beta diversity stats</h1>
+            <h1>Beta diversity stats ({metric})</h1>
             <h2>To find further sequence specific information, refer to table 03 generated previously.</h2>
             <strong>Please refer to the excel file generated to perform further analysis. </strong>
             <p>Date file was generated: {time_generated}</p>
+            <p>Variance captured by the computed axes: {captured:.2%}</p>
             <h2>Distance points</h2>
             {dists_pts.to_html()}
-            <h2>PERMANOVA results</h2>
-            {sig_results.to_html()}''')
-
-
-def beta_diversity(asv_table,
-                   map_file,
-                   data_column,
-                   treatments,
-                   plot_tilte,
-                   pairwise,
-                   output) -> None:
-
-    # Split treatments into list
-    treatments = tuple(treatments[0].split(','))
-
-    # Filter asv table to include only samples from specified group
-    asv_table_filtered = feature_table.methods.filter_samples(table=asv_table,
-                                                              metadata=map_file,
-                                                              where=f"[{data_column}] IN {treatments}")
-    asv_table_filtered = asv_table_filtered.filtered_table
-
-    # Preform Braycurtis metric
-    beta_results = diversity.pipelines.beta(
-            table=asv_table_filtered,
-            metric='braycurtis')
-
-    beta_diversity_table = beta_results.distance_matrix
-
-    # Convert qiime2 distance martix object into skbio DistanceMatrix
-    # https://forum.qiime2.org/t/load-distancematrix-artifact-to-dataframe/11660
-    pcoa_results = diversity.methods.pcoa(distance_matrix=beta_diversity_table)
-    pcoa_results = pcoa_results.pcoa
-    pcoa_results = pcoa_results.view(OrdinationResults)
-
-    # Output Ordination results and calculate sum of eigen values
-    print(pcoa_results)
-    eigen_values = pcoa_results.eigvals
-    total_eigen_values = eigen_values.sum()
-
-    # Extract distance points from pcoa results
-    # https://medium.com/@conniezhou678/applied-machine-learning-part-12-principal-coordinate-analysis-pcoa-in-python-5acc2a3afe2d
-    # https://www.tutorialspoint.com/numpy/numpy_matplotlib.htm
-    pcoa_results = pcoa_results.samples
-   
-    if pairwise == True:
-        sig_results = significance_test_pairswise(beta_diversity_table,
-                                   map_file,
-                                   treatments,
-                                   data_column) 
-    else:
-        sig_results = significance_test_non_pairwise(beta_diversity_table,
-                                   map_file,
-                                   data_column)
-
-    # Generate statsics
-    stats_generator(pcoa_results,
-                    output,
-                    sig_results)
-
+            <h2>Group tests (PERMANOVA, ANOSIM, PERMDISP)</h2>
+            {sig_results.to_html()}'''
+
+    # Write distance points/sig test in every requested format at the same time
+    suffix = metric_suffix(metric)
+    write_outputs(output,
+                  {f'beta_diversity_stats{suffix}': dists_pts,
+                   f'significance_test_results{suffix}': sig_results},
+                  {'md': (f'beta_diversity_stats{suffix}.md', markdown),
+                   'html': (f'beta_diversity_stats{suffix}.html', html)},
+                  formats)
+
+
+def visualizer(ordination,
+               map_file,
+               data_column,
+               treatments,
+               plot_tilte,
+               output,
+               styles=None,
+               filename='beta_diversity.png') -> None:
     fig, ax = plt.subplots(figsize=(15, 10))
-
-    # Generate and assign color mapping
-    mapping = {}
-    for i in range(len(treatments)):
-        match = re.search(r'Tm(\d+)', treatments[i])
-
-        if not match:
-            raise ValueError(f"Treatment name invalid: {treatments[i]}")
-    
-        Tm = int(match.group(1))
-        if Tm == 0:
-            mapping[treatments[i]] = 'blue'
-        elif Tm == 154:
-            mapping[treatments[i]] = 'orange'
-
-    column = map_file.get_column(data_column)
-
-    # Generate Scatter plot
-    for row in pcoa_results.itertuples():
-        label = column.get_value(row.Index)
-
-        markers = [".", "o", "^", "s", "p", "P", "*", "H", "X", "D"]
-        marker = re.search(r'T(\d+)', label)
-        if not marker:
-            raise ValueError(f"Label name invalid: {label}")
-        marker = int(marker.group(1))
-        ax.scatter(
-            row[1],
-            row[2],
-            color=mapping[label],
-            label=label,
-            marker=markers[marker % len(markers)],
-            s=150,
-            zorder=2,
-        )
+    styles = styles or {}
+
+    # Join the first two axes with the treatment of every sample
+    mapping = treatment_mapping(map_file, data_column, treatments)
+    points = ordination.samples.iloc[:, :2].set_axis(['x', 'y'], axis=1)
+    points = points.join(mapping.rename('treatment'), how='inner')
+
+    # Generate and assign color/marker mapping
+    # *Treatments outside the color scheme get a color from the shared registry
+    color_map, marker_map = treatment_styles(treatments,
+                                             styles.get('color_pattern', DEFAULT_COLOR_PATTERN),
+                                             styles.get('colors', DEFAULT_COLORS),
+                                             styles.get('marker_pattern', DEFAULT_MARKER_PATTERN))
+    unstyled = [treatment for treatment in treatments if color_map[treatment] is None]
+    if unstyled:
+        fallback = load_or_create_color_map(unstyled, output)
+        color_map.update({treatment: fallback[treatment] for treatment in unstyled})
+
+    # One scatter call per treatment, legend follows the order of the treatments
+    handles = grouped_scatter(ax, points, 'x', 'y', 'treatment', list(treatments), color_map, marker_map)
 
     # Calculate distance axis
-    plt.ylabel(f'Axis 2 [{(eigen_values[1]/total_eigen_values):.2%}]', fontsize='15')
-    plt.xlabel(f'Axis 1 [{(eigen_values[0]/total_eigen_values):.2%}]', fontsize='15')
-
-    # Filter out duplicates from legend table
-    # https://stackoverflow.com/questions/13588920/stop-matplotlib-repeating-labels-in-legend
-    handles, labels = plt.gca().get_legend_handles_labels()
-    uniques = dict(zip(labels, handles))
-    # maintain order of treatments in legend
-    uniques = {k: uniques[k] for k in treatments if k in uniques}
-
-    ax.legend(uniques.values(),
-              uniques.keys(),
+    plt.ylabel(axis_label(ordination, 1), fontsize='15')
+    plt.xlabel(axis_label(ordination, 0), fontsize='15')
+
+    ax.legend(handles,
+              [handle.get_label() for handle in handles],
               bbox_to_anchor=(1, 1),
               frameon=False,
               title="Treatments",
@@ -304,7 +229,216 @@ def beta_diversity(asv_table,
     ax.spines['right'].set_visible(False)
     fig.tight_layout()
     plt.grid(True)
-    fig.savefig(f"{output}beta_diversity.png", dpi=300)
+    fig.savefig(f"{output}{filename}", dpi=300)
+    plt.close(fig)
+
+
+def metric_suffix(metric) -> str:
+    # Bray-Curtis keeps the original output file names, other metrics get a suffix
+    return '' if metric == 'braycurtis' else f'_{metric}'
+
+
+def native_distances(asv_table,
+                     table,
+                     samples,
+                     metrics,
+                     output,
+                     dtype=np.float64,
+                     workers=None,
+                     cache_dir=None,
+                     cache_size=10,
+                     update=False) -> dict:
+    # Every requested metric for the given samples, saved as <metric>_distance_matrix.npy
+    # *The filtered matrix and its transforms (totals, presence, CLR) are built once and
+    #  the row blocks of every metric run on one thread pool
+    paths = {metric: f"{output}{metric}_distance_matrix.npy" for metric in metrics}
+    positions, _ = table.sample_positions(samples)
+
+    updated = {}
+    if update:
+        # Only the rows of samples new to a saved matrix are computed, the saved
+        # matrix keeps every sample it has seen and the run slices its samples out
+        for metric in metrics:
+            if load_feature_state(paths[metric]) is None:
+                continue
+            try:
+                matrix, saved_samples = update_distances(paths[metric],
+                                                         metric,
+                                                         table.counts,
+                                                         table.features,
+                                                         table.samples.astype(str),
+                                                         add=samples,
+                                                         workers=workers)
+            except ValueError as e:
+                print(f"Incremental update rejected ({metric}): {e}, recomputing")
+                continue
+            index = pd.Index(saved_samples).get_indexer(samples)
+            updated[metric] = np.asarray(matrix[np.ix_(index, index)])
+            print(f"Updated {paths[metric]} to {len(saved_samples)} samples")
+        metrics = [metric for metric in metrics if metric not in updated]
+
+    if not metrics:
+        distances = {}
+    elif cache_dir:
+        # The full matrix of the table is cached once per metric, subsets are sliced out of it
+        cache = DistanceCache(cache_dir, int(cache_size * 1024 ** 3))
+        table_id = str(asv_table.uuid) if hasattr(asv_table, 'uuid') else content_hash(table)
+        full_matrix = None
+        distances = {}
+        for metric in metrics:
+            key = DistanceCache.key(table_id, metric, dtype)
+            if (cached := cache.get(key, samples)) is None:
+                full_matrix = full_matrix or SampleMatrix(table.counts)
+                cache.put(key,
+                          table.samples.astype(str),
+                          lambda path: distance_matrices(full_matrix, [metric], dtype, paths={metric: path}, workers=workers))
+                cached = cache.read(key, samples)
+            distances[metric], _ = cached
+            np.save(paths[metric], distances[metric])
+        print(cache.report())
+    else:
+        distances = distance_matrices(SampleMatrix(table.counts[:, positions]), metrics, dtype, paths=paths, workers=workers)
+
+    for metric in metrics:
+        save_sample_ids(paths[metric], samples)
+        save_feature_state(paths[metric], metric, table.counts[:, positions], table.features)
+    distances.update(updated)
+    return distances
+
+
+def beta_diversity(asv_table,
+                   map_file,
+                   data_column,
+                   treatments,
+                   plot_tilte,
+                   pairwise,
+                   output,
+                   output_formats=None,
+                   use_qiime2=False,
+                   dtype=np.float64,
+                   workers=None,
+                   dimensions=None,
+                   seed=0,
+                   cache_dir=None,
+                   cache_size=10,
+                   styles=None,
+                   metrics=('braycurtis',),
+                   permutations=None,
+                   alpha=0.05,
+                   max_permutations=MAX_PERMUTATIONS,
+                   tests=GROUP_TESTS,
+                   update=False) -> None:
+
+    # Split treatments into list
+    treatments = tuple(treatments[0].split(','))
+
+    distance_tables = {}
+    sample_ids = {}
+    ordinations = {}
+    if use_qiime2:
+        # Filter asv table to include only samples from specified group
+        asv_table_filtered = feature_table.methods.filter_samples(table=asv_table,
+                                                                  metadata=map_file,
+                                                                  where=f"[{data_column}] IN {treatments}")
+        asv_table_filtered = asv_table_filtered.filtered_table
+
+        for metric in metrics:
+            # Preform each beta metric
+            beta_results = diversity.pipelines.beta(
+                    table=asv_table_filtered,
+                    metric=metric)
+
+            distance_matrix = beta_results.distance_matrix
+
+            # Convert qiime2 distance martix object into skbio DistanceMatrix
+            # https://forum.qiime2.org/t/load-distancematrix-artifact-to-dataframe/11660
+            pcoa_results = diversity.methods.pcoa(distance_matrix=distance_matrix,
+                                                  number_of_dimensions=dimensions)
+            pcoa_results = pcoa_results.pcoa
+            ordinations[metric] = pcoa_results.view(OrdinationResults)
+
+            # The tests (and their sample ids) work on the skbio DistanceMatrix behind the artifact
+            distance_tables[metric], sample_ids[metric] = distance_data(distance_matrix)
+    else:
+        # Preform every beta metric on the sparse counts of the samples from the specified group
+        # *Computed in row blocks on several threads and written to memory mapped .npy files
+        table = SparseFeatureTable.from_artifact(asv_table)
+        mapping = treatment_mapping(map_file, data_column, treatments)
+        mapping = report_missing(mapping, table.samples.astype(str))
+        positions, _ = table.sample_positions(mapping.index)
+        samples = table.samples.astype(str)[positions]
+
+        distances = native_distances(asv_table, table, samples, metrics, output, dtype, workers, cache_dir, cache_size, update)
+        for metric in metrics:
+            # The tests read the (float32 / memory mapped) matrix as it is, only the PCoA gets a float64 copy
+            distance_tables[metric] = distances[metric]
+            sample_ids[metric] = list(samples)
+            # Only the requested number of axes are computed (randomized svd) when dimensions is set
+            ordinations[metric] = ordinate(distances[metric], dimensions, ids=sample_ids[metric])
+
+    for metric in metrics:
+        print(f"Beta diversity ({metric})...")
+        beta_diversity_table = distance_tables[metric]
+        ordination = ordinations[metric]
+
+        # Output Ordination results and how much of the eigen value sum the computed axes hold
+        # *Axis percentages come from proportion_explained, which is taken over every eigen value
+        print(ordination)
+        captured = captured_variance(ordination)
+        print(f"Variance captured by {len(ordination.eigvals)} axes: {captured:.2%}")
+
+        # Extract distance points from pcoa results
+        # https://medium.com/@conniezhou678/applied-machine-learning-part-12-principal-coordinate-analysis-pcoa-in-python-5acc2a3afe2d
+        # https://www.tutorialspoint.com/numpy/numpy_matplotlib.htm
+        pcoa_results = ordination.samples
+
+        # PERMDISP measures the spread of every group around its centroid on the computed axes
+        # *Only the requested axes when --dimensions is set, so its F is then approximate
+        coordinates = pcoa_results.reindex(sample_ids[metric]).to_numpy()
+
+        if pairwise == True:
+            sig_results = significance_test_pairswise(beta_diversity_table,
+                                       map_file,
+                                       treatments,
+                                       data_column,
+                                       permutations=permutations,
+                                       seed=seed,
+                                       workers=workers,
+                                       alpha=alpha,
+                                       max_permutations=max_permutations,
+                                       coordinates=coordinates,
+                                       tests=tests,
+                                       ids=sample_ids[metric])
+        else:
+            sig_results = significance_test_non_pairwise(beta_diversity_table,
+                                       map_file,
+                                       data_column,
+                                       treatments,
+                                       permutations=permutations,
+                                       seed=seed,
+                                       alpha=alpha,
+                                       max_permutations=max_permutations,
+                                       coordinates=coordinates,
+                                       tests=tests,
+                                       ids=sample_ids[metric])
+
+        # Generate statsics
+        stats_generator(pcoa_results,
+                        output,
+                        sig_results,
+                        output_formats,
+                        captured,
+                        metric)
+
+        # Generate Scatter plot
+        visualizer(ordination,
+                   map_file,
+                   data_column,
+                   treatments,
+                   plot_tilte,
+                   output,
+                   styles,
+                   f'beta_diversity{metric_suffix(metric)}.png')
 
 
 def validate_data(asv_table) -> None:
@@ -360,6 +494,86 @@ if __name__ == '__main__':
                         help="Output directory location",
                         type=str)
 
+    parser.add_argument("--output-formats",
+                        nargs='+',
+                        type=str,
+                        help=f"Stats file formats to write ({', '.join(OUTPUT_FORMATS)}), Default is xlsx md html")
+
+    parser.add_argument("--metrics",
+                        nargs='+',
+                        type=str,
+                        default=['braycurtis'],
+                        help=f"Beta metrics to compute in one run ({', '.join(METRICS)}), Default is braycurtis")
+
+    parser.add_argument("--qiime2-beta",
+                        action="store_true",
+                        help="Use the qiime 2 beta pipeline (keeps provenance, slower)")
+
+    parser.add_argument("--dimensions",
+                        type=int,
+                        help="Only compute this many PCoA axes with randomized svd (Default is every axis)")
+
+    parser.add_argument("--permutations",
+                        type=int,
+                        help="Run exactly this many permutations per group test (Default is adaptive, stopping once the p value is settled against --alpha)")
+
+    parser.add_argument("--tests",
+                        nargs='+',
+                        type=str,
+                        default=list(GROUP_TESTS),
+                        help=f"Group tests to run on the same permutations ({', '.join(GROUP_TESTS)}), Default is every test")
+
+    parser.add_argument("--max-permutations",
+                        type=int,
+                        default=MAX_PERMUTATIONS,
+                        help=f"Most permutations an adaptive test may use, Default is {MAX_PERMUTATIONS}")
+
+    parser.add_argument("--alpha",
+                        type=float,
+                        default=0.05,
+                        help="Significance threshold the adaptive permutations resolve p values against, Default is 0.05")
+
+    parser.add_argument("--seed",
+                        type=int,
+                        default=0,
+                        help="Seed for the group test permutations, Default is 0")
+
+    parser.add_argument("--cache-dir",
+                        type=str,
+                        help="Reuse full distance matrices of the same table from this directory")
+
+    parser.add_argument("--cache-size",
+                        type=float,
+                        default=10,
+                        help="Size budget of the distance matrix cache in GB, Default is 10")
+
+    parser.add_argument("--color-pattern",
+                        type=str,
+                        default=DEFAULT_COLOR_PATTERN,
+                        help=f"Regex whose first group picks a treatment's color, Default is {DEFAULT_COLOR_PATTERN}")
+
+    parser.add_argument("--colors",
+                        nargs='+',
+                        type=str,
+                        help="Colors for the color pattern keys as key=color, Default is 0=blue 154=orange (other treatments get registry colors)")
+
+    parser.add_argument("--marker-pattern",
+                        type=str,
+                        default=DEFAULT_MARKER_PATTERN,
+                        help=f"Regex whose first (numeric) group picks a treatment's marker, Default is {DEFAULT_MARKER_PATTERN}")
+
+    parser.add_argument("--update",
+                        action="store_true",
+                        help="Add new samples to the distance matrices saved in the output directory instead of recomputing them (falls back to a full run when the features or counts changed)")
+
+    parser.add_argument("--float32",
+                        action="store_true",
+                        help="Store the distance matrix as float32 (half the memory)")
+
+    parser.add_argument("--workers",
+                        type=int,
+                        help="Threads used to compute the distance matrix and processes used for the pairwise group tests (Default is every CPU)")
+
     parser.add_argument('-h',
                         '--help',
                         action='help',
@@ -374,6 +588,19 @@ if __name__ == '__main__':
     plot_tilte = args.plot_title
     treatments = args.listing
     output = os.path.join(args.output_dir, "beta-diversity/")
+    try:
+        output_formats = parse_formats(args.output_formats)
+        styles = {'color_pattern': re.compile(args.color_pattern),
+                  'colors': parse_style_map(args.colors),
+                  'marker_pattern': re.compile(args.marker_pattern)}
+    except (ValueError, re.error) as e:
+        parser.error(str(e))
+    metrics = list(dict.fromkeys(','.join(args.metrics).split(',')))
+    if any(metric not in METRICS for metric in metrics):
+        parser.error(f"Unknown beta metric, choose from {', '.join(METRICS)}")
+    tests = list(dict.fromkeys(','.join(args.tests).split(',')))
+    if any(test not in GROUP_TESTS for test in tests):
+        parser.error(f"Unknown group test, choose from {', '.join(GROUP_TESTS)}")
 
     # Load in ASV table and map file
     if ((asv_table := validate_data(data_file)) is not None) and ((map_file := Metadata.load(map_file)) is not None):
@@ -386,7 +613,22 @@ if __name__ == '__main__':
                        treatments,
                        plot_tilte,
                        pairwise,
-                       output)
+                       output,
+                       output_formats,
+                       args.qiime2_beta,
+                       np.float32 if args.float32 else np.float64,
+                       args.workers,
+                       args.dimensions,
+                       args.seed,
+                       args.cache_dir,
+                       args.cache_size,
+                       styles,
+                       metrics,
+                       args.permutations,
+                       args.alpha,
+                       args.max_permutations,
+                       tests,
+                       args.update)
     else:
         print('Invalid data type or map file')
         exit(1)
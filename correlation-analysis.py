@@ -8,28 +8,8 @@ import scipy.stats as stats
 from qiime2 import Metadata
 from qiime2 import Artifact
 
-#To clean up asv labels
-def asv_label_formatter(asv_list):
-    for i in range(len(asv_list)):
-        if 'Other' in asv_list[i] or '__':
-            if 'g__' in asv_list[i]:
-                asv_list[i] = asv_list[i].split(';')[5]
-                
-            elif 'f__' in asv_list[i]:
-                asv_list[i] = asv_list[i].split(';')[4]
-                
-            elif 'o__' in asv_list[i]:
-                asv_list[i] = asv_list[i].split(';')[3]
-                
-            elif 'c__' in asv_list[i]:
-                asv_list[i] = asv_list[i].split(';')[2]
-                
-            elif 'p__' in asv_list[i]:
-                asv_list[i] = asv_list[i].split(';')[1]
-            else:
-                asv_list[i] = asv_list[i].split(';')[0]
-        else:
-            asv_list[i]=asv_list[i].split(';')[-1]
+from microbio_tools.taxonomy import deepest_labels
+
 
 def correlation_analysis(map_file,
                          corr_col_0,
@@ -45,7 +25,7 @@ def correlation_analysis(map_file,
     top_n = top_n.set_index('Treatments')
     new_lables = top_n.columns.to_list()
     
-    asv_label_formatter(new_lables)
+    new_lables = deepest_labels(new_lables)
     top_n.columns = new_lables
 
 
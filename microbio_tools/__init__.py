@@ -0,0 +1,4 @@
+# Shared helpers for the MicroBio_Tools scripts.
+# The scripts at the top of the repo add this package to their import path by
+# being run from the repo directory, so keep everything here importable
+# without qiime2 unless a module explicitly needs it.
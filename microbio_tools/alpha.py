@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+
+def _sample_columns(counts):
+    # CSC view of a features x samples matrix plus the sample of every nonzero
+    counts = sp.csc_matrix(counts)
+    columns = np.repeat(np.arange(counts.shape[1]), np.diff(counts.indptr))
+    return counts, columns
+
+
+# Metric name (as given to qiime2) -> column name of the qiime2 result
+METRIC_COLUMNS = {'shannon': 'shannon_entropy',
+                  'simpson': 'simpson',
+                  'observed_features': 'observed_features',
+                  'chao1': 'chao1',
+                  'pielou_e': 'pielou_evenness'}
+
+# Axis labels for the plots
+METRIC_LABELS = {'shannon': 'Shannon Diversity',
+                 'simpson': 'Simpson Diversity',
+                 'observed_features': 'Observed Features',
+                 'chao1': 'Chao1 Richness',
+                 'pielou_e': 'Pielou Evenness'}
+
+
+def metric_suffix(metric: str) -> str:
+    # Shannon keeps the original output file names, other metrics get a suffix
+    return '' if metric == 'shannon' else f'_{metric}'
+
+
+def alpha_metrics(counts, metrics) -> dict:
+    # Several alpha metrics from one pass over a sparse features x samples count
+    # matrix. Row sums, observed/singleton/doubleton counts and the frequencies
+    # are computed once and shared by every metric. Matches skbio's definitions
+    # (shannon in base 2, bias corrected chao1, pielou_e from the natural log),
+    # including NaN for the metrics an empty sample has no value for.
+    unknown = [metric for metric in metrics if metric not in METRIC_COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown alpha metric(s): {', '.join(unknown)} (choose from {', '.join(METRIC_COLUMNS)})")
+
+    counts, columns = _sample_columns(counts)
+    n_samples = counts.shape[1]
+    data = counts.data.astype(np.float64)
+    nonzero = data > 0
+
+    totals = np.bincount(columns, weights=data, minlength=n_samples)
+    observed = np.bincount(columns, weights=nonzero, minlength=n_samples)
+    singles = np.bincount(columns, weights=data == 1, minlength=n_samples)
+    doubles = np.bincount(columns, weights=data == 2, minlength=n_samples)
+
+    safe_totals = np.where(totals > 0, totals, 1)
+    freqs = np.where(nonzero, data / safe_totals[columns], 1)
+    entropy = np.bincount(columns, weights=-freqs * np.log(freqs), minlength=n_samples)
+    sum_squares = np.bincount(columns, weights=np.where(nonzero, freqs, 0) ** 2, minlength=n_samples)
+
+    results = {}
+    for metric in metrics:
+        if metric == 'shannon':
+            values = np.where(totals > 0, entropy / np.log(2), np.nan)
+        elif metric == 'simpson':
+            values = np.where(totals > 0, 1 - sum_squares, np.nan)
+        elif metric == 'observed_features':
+            values = observed
+        elif metric == 'chao1':
+            values = observed + singles * (singles - 1) / (2 * (doubles + 1))
+        elif metric == 'pielou_e':
+            # Undefined (NaN) for empty and single taxon samples, like skbio 0.6
+            with np.errstate(divide='ignore', invalid='ignore'):
+                values = np.where(observed > 1, entropy / np.log(np.maximum(observed, 2)), np.nan)
+        results[METRIC_COLUMNS[metric]] = values
+    return results
+
+
+def alpha_table(table, metrics, sample_ids=None) -> pd.DataFrame:
+    # In process replacement for diversity.pipelines.alpha on a SparseFeatureTable,
+    # optionally limited to the given samples. One column per metric, named like
+    # the qiime2 result columns (i.e. 'shannon_entropy').
+    counts = table.counts
+    samples = table.samples.astype(str)
+    if sample_ids is not None:
+        positions, _ = table.sample_positions(sample_ids)
+        counts = counts[:, positions]
+        samples = samples[positions]
+
+    return pd.DataFrame(alpha_metrics(counts, metrics), index=pd.Index(samples, name='samples'))
+
+
+def alpha_long_table(alpha_table: pd.DataFrame, mapping: pd.Series, metrics, treatments) -> pd.DataFrame:
+    # Join the sample -> treatment mapping onto the alpha scores and melt into a
+    # long (samples, treatment, metric, value) table, one row per sample and metric.
+    # Samples missing from the alpha table should already be dropped from mapping.
+    columns = [METRIC_COLUMNS[metric] for metric in metrics]
+    joined = mapping.rename('treatment').to_frame().join(alpha_table[columns], how='inner')
+    joined = joined.rename(columns={METRIC_COLUMNS[metric]: metric for metric in metrics})
+    joined.index.name = 'samples'
+    long_table = joined.reset_index().melt(id_vars=['samples', 'treatment'], var_name='metric', value_name='value')
+    # Keep the metrics and treatments in the requested order
+    long_table['metric'] = pd.Categorical(long_table['metric'], categories=list(metrics))
+    long_table['treatment'] = pd.Categorical(long_table['treatment'], categories=list(treatments))
+    return long_table.sort_values(['metric', 'treatment', 'value'], kind='stable', ignore_index=True)
@@ -0,0 +1,94 @@
+import json
+import multiprocessing as mp
+import os
+import re
+
+from microbio_tools.writers import parse_formats
+
+# Keys a batch job may set, anything else in the manifest is rejected
+JOB_KEYS = {'name', 'column', 'treatments', 'top_n', 'title', 'formatter', 'split_replicates', 'filter', 'formats'}
+
+# Set by run_shared right before forking so the workers share it, see shared_state()
+_SHARED_STATE = None
+
+
+def load_manifest(manifest_file: str) -> list:
+    # Read a YAML or JSON manifest, either a list of jobs or {'jobs': [...]}
+    with open(manifest_file, 'r') as f:
+        if manifest_file.endswith(('.yml', '.yaml')):
+            import yaml
+            manifest = yaml.safe_load(f)
+        else:
+            manifest = json.load(f)
+
+    if isinstance(manifest, dict):
+        manifest = manifest.get('jobs', [])
+    if not isinstance(manifest, list) or len(manifest) == 0:
+        raise ValueError(f"No jobs found in manifest: {manifest_file}")
+
+    return [normalize_job(job, i) for i, job in enumerate(manifest)]
+
+
+def normalize_job(job: dict, index: int) -> dict:
+    unknown = set(job) - JOB_KEYS
+    if unknown:
+        raise ValueError(f"Job {index} has unknown keys: {sorted(unknown)}")
+    if 'column' not in job or 'formatter' not in job:
+        raise ValueError(f"Job {index} needs at least a 'column' and a 'formatter'")
+    if job['formatter'] not in ('b', 'j', 'q'):
+        raise ValueError(f"Job {index} has an invalid formatter: {job['formatter']}")
+    if job['formatter'] != 'q' and 'top_n' not in job:
+        raise ValueError(f"Job {index} needs a 'top_n' value")
+
+    treatments = job.get('treatments', [])
+    if isinstance(treatments, str):
+        treatments = treatments.split(',')
+
+    name = job.get('name') or f"{index:03d}_{job['column']}_{job['formatter']}"
+    return {'name': re.sub(r'[^\w.-]+', '_', str(name)),
+            'column': job['column'],
+            'treatments': [str(t) for t in treatments],
+            'top_n': int(job.get('top_n', 0)),
+            'title': job.get('title', job['column']),
+            'formatter': job['formatter'],
+            'split_replicates': bool(job.get('split_replicates', False)),
+            'filter': bool(job.get('filter', False)),
+            'formats': parse_formats(job['formats']) if job.get('formats') else None}
+
+
+def job_output_dir(output: str, job: dict) -> str:
+    # Every job writes to its own sub directory of the output directory
+    job_dir = os.path.join(output, job['name'], '')
+    os.makedirs(job_dir, exist_ok=True)
+    return job_dir
+
+
+def run_jobs(jobs: list, run_job, workers: int = 1) -> list:
+    # Run each job with run_job(job) -> result. With more than one worker the jobs
+    # go to a forked process pool so the table and map file loaded by the parent
+    # are shared with the workers instead of being pickled or reloaded.
+    if workers <= 1 or len(jobs) <= 1:
+        return [run_job(job) for job in jobs]
+
+    context = mp.get_context('fork')
+    with context.Pool(processes=min(workers, len(jobs))) as pool:
+        return pool.map(run_job, jobs, chunksize=1)
+
+
+def shared_state():
+    # The state given to the run_shared call this task belongs to
+    return _SHARED_STATE
+
+
+def run_shared(tasks: list, run_task, state, workers: int = 1) -> list:
+    # run_jobs for tasks that read large state (a count or distance matrix). The
+    # state is set here right before the pool forks, so the workers inherit it
+    # instead of getting a pickled copy with every task, and run_task reads it
+    # back with shared_state(). The previous state is restored afterwards.
+    global _SHARED_STATE
+    previous = _SHARED_STATE
+    _SHARED_STATE = state
+    try:
+        return run_jobs(tasks, run_task, workers)
+    finally:
+        _SHARED_STATE = previous
@@ -0,0 +1,124 @@
+#On disk cache of full distance matrices, keyed by the table contents and the metric
+import glob
+import hashlib
+import os
+
+import numpy as np
+from filelock import FileLock
+
+from microbio_tools.distance import load_distances, save_sample_ids
+
+# Default size budget of a cache directory
+CACHE_BYTES = 10 * 1024 ** 3
+
+
+def content_hash(table) -> str:
+    # sha256 of a SparseFeatureTable's counts and ids, for tables without a qiime2 uuid
+    counts = table.counts.tocsr()
+    counts.sort_indices()
+    digest = hashlib.sha256()
+    for array in (counts.indptr, counts.indices, counts.data):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    for ids in (table.features, table.samples):
+        digest.update('\n'.join(map(str, ids)).encode())
+    return digest.hexdigest()
+
+
+class DistanceCache:
+    # Full distance matrices of a table (every sample) stored as <key>.npy plus
+    # <key>_samples.txt. A run on a subset of the samples slices its rows and
+    # columns out of the memory mapped matrix instead of recomputing it. Entries
+    # are evicted least recently used first once the directory is over budget,
+    # a hit refreshes the entry's modification time.
+
+    def __init__(self, directory: str, max_bytes: int = CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = FileLock(os.path.join(directory, 'cache.lock'))
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(table_id: str, metric: str, dtype=np.float64) -> str:
+        # table_id is the artifact uuid or content_hash(table)
+        return hashlib.sha256(f'{table_id}:{metric}:{np.dtype(dtype).name}'.encode()).hexdigest()[:32]
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.npy')
+
+    def read(self, key: str, samples=None):
+        # (matrix, samples) for the requested samples (every sample when None),
+        # or None when the entry or some of the samples are missing. Reads take
+        # no lock, an entry another run evicts while we open it is a miss (an
+        # already mapped matrix stays readable after it is removed).
+        path = self.path(key)
+        try:
+            matrix, cached_samples = load_distances(path)
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        if samples is None:
+            positions = np.arange(len(cached_samples))
+        else:
+            index = {sample: i for i, sample in enumerate(cached_samples)}
+            positions = np.array([index.get(str(sample), -1) for sample in samples], dtype=np.int64)
+            if (positions < 0).any():
+                return None
+        return matrix[np.ix_(positions, positions)], [cached_samples[i] for i in positions]
+
+    def get(self, key: str, samples=None):
+        # read() that is counted as a cache hit or miss
+        result = self.read(key, samples)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def put(self, key: str, samples, compute):
+        # Write the full matrix with compute(path) -> memory mapped matrix, then
+        # move it into place so other runs never see a partial entry
+        path = self.path(key)
+        temp_path = f'{path}.{os.getpid()}.tmp.npy'
+        try:
+            compute(temp_path)
+            with self.lock:
+                save_sample_ids(path, samples)
+                os.replace(temp_path, path)
+                self.evict(keep=key)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return path
+
+    def entries(self) -> list:
+        # (modification time, size, path) of every entry, oldest first
+        entries = []
+        for path in glob.glob(os.path.join(self.directory, '*.npy')):
+            if path.endswith('.tmp.npy'):
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def evict(self, keep: str = None) -> list:
+        # Drop least recently used entries until the cache fits its budget
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        removed = []
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if keep and os.path.basename(path) == f'{keep}.npy':
+                continue
+            os.remove(path)
+            samples_path = f'{os.path.splitext(path)[0]}_samples.txt'
+            if os.path.exists(samples_path):
+                os.remove(samples_path)
+            total -= size
+            removed.append(path)
+        return removed
+
+    def report(self) -> str:
+        return f"Distance matrix cache: {self.hits} hit(s), {self.misses} miss(es)"
@@ -0,0 +1,110 @@
+import json
+import os
+import tempfile
+
+import matplotlib.pyplot as plt
+from filelock import FileLock
+
+REGISTRY_FILE = 'color_map.jsonl'
+LEGACY_FILE = 'color_map.json'
+
+
+def palette() -> list:
+    # tab20 + tab20b + tab20c gives 60 distinct colors before anything is reused
+    colors = []
+    for name in ('tab20', 'tab20b', 'tab20c'):
+        cmap = plt.get_cmap(name)
+        colors.extend(tuple(float(c) for c in cmap(i)) for i in range(cmap.N))
+    return colors
+
+
+class ColorRegistry:
+    # Append-only color registry shared by every run writing to the same output
+    # directory. Each line of color_map.jsonl assigns a color to one taxon, so
+    # adding taxa is a small append under a file lock instead of rewriting the
+    # whole map, and existing assignments never change.
+
+    def __init__(self, outputdir: str):
+        self.path = os.path.join(outputdir, REGISTRY_FILE)
+        self.legacy_path = os.path.join(outputdir, LEGACY_FILE)
+        self.lock = FileLock(self.path + '.lock')
+        self.palette = palette()
+
+    def _read(self) -> dict:
+        color_map = {}
+        if not os.path.exists(self.path):
+            return color_map
+        with open(self.path, 'r') as f:
+            for line in f:
+                # A line without a newline is still being written by another run
+                if not line.endswith('\n'):
+                    break
+                entry = json.loads(line)
+                color_map.setdefault(entry['taxon'], tuple(entry['color']))
+        return color_map
+
+    def _repair(self):
+        # Under the lock nobody else is writing, so a last line without a newline
+        # is left over from a run that crashed mid write: cut the file back to the
+        # last complete line so the next append starts on a line of its own
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb+') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b'\n':
+                return
+            f.seek(0)
+            keep = f.read().rfind(b'\n') + 1
+            print("Dropping a partially written line from the color map")
+            f.truncate(keep)
+
+    def _migrate_legacy(self):
+        # Carry colors over from an old color_map.json, written atomically
+        if os.path.exists(self.path) or not os.path.exists(self.legacy_path):
+            return
+        print("Migrating existing color map...")
+        with open(self.legacy_path, 'r') as f:
+            legacy = json.load(f)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.', suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            for taxon, color in legacy.items():
+                f.write(json.dumps({'taxon': taxon, 'color': list(color)}) + '\n')
+        os.replace(temp_path, self.path)
+
+    def colors(self, headers) -> dict:
+        color_map = self._read()
+        missing = [taxon for taxon in dict.fromkeys(headers) if taxon not in color_map]
+        if not missing:
+            return color_map
+
+        with self.lock:
+            self._migrate_legacy()
+            self._repair()
+            # Another run may have added taxa since we last read the registry
+            color_map = self._read()
+            missing = [taxon for taxon in missing if taxon not in color_map]
+            if len(color_map) + len(missing) > len(self.palette):
+                print(f"Warning: Not enough colors for all taxons, reusing colors")
+
+            lines = []
+            for taxon in missing:
+                color = self.palette[len(color_map) % len(self.palette)]
+                color_map[taxon] = color
+                lines.append(json.dumps({'taxon': taxon, 'color': list(color)}) + '\n')
+
+            with open(self.path, 'a') as f:
+                f.write(''.join(lines))
+                f.flush()
+                os.fsync(f.fileno())
+
+        return color_map
+
+
+def load_or_create_color_map(headers, outputdir):
+    color_map = ColorRegistry(outputdir).colors(headers)
+    print("Color map loaded successfully")
+    return color_map
@@ -0,0 +1,420 @@
+#Native beta diversity distances computed straight from the sparse count matrix
+import hashlib
+import importlib.util
+import io
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.spatial.distance import cdist
+
+# Rows per block, each block is compared against every later sample
+BLOCK_SIZE = 256
+
+# Metrics computed natively (names as given to qiime2's beta pipeline)
+METRICS = ['braycurtis', 'jaccard', 'aitchison', 'canberra']
+
+# Pseudocount added to every count before the CLR (like qiime2's aitchison)
+PSEUDOCOUNT = 1
+
+# numba is optional, without it the blocks are densified and handed to cdist
+HAVE_NUMBA = importlib.util.find_spec('numba') is not None
+_KERNELS = {}
+
+
+def _sparse_kernel(metric: str):
+    # Compile the sparse kernel of a metric on first use. It walks the sorted
+    # nonzeros of both samples, so a pair costs nnz(a) + nnz(b), and releases
+    # the GIL so blocks run on plain threads.
+    if metric in _KERNELS:
+        return _KERNELS[metric]
+    import numba
+
+    if metric == 'braycurtis':
+        @numba.njit(nogil=True, cache=True)
+        def kernel(indptr, indices, data, totals, rows, columns, out):
+            for a in range(rows.size):
+                i = rows[a]
+                for b in range(columns.size):
+                    j = columns[b]
+                    denominator = totals[i] + totals[j]
+                    if denominator == 0:
+                        out[a, b] = 0.0
+                        continue
+                    shared = 0.0
+                    p, p_end = indptr[i], indptr[i + 1]
+                    q, q_end = indptr[j], indptr[j + 1]
+                    while p < p_end and q < q_end:
+                        if indices[p] == indices[q]:
+                            shared += min(data[p], data[q])
+                            p += 1
+                            q += 1
+                        elif indices[p] < indices[q]:
+                            p += 1
+                        else:
+                            q += 1
+                    out[a, b] = 1.0 - 2.0 * shared / denominator
+    else:
+        # Canberra: every feature present in only one sample adds 1, shared
+        # features add |a - b| / (a + b)
+        @numba.njit(nogil=True, cache=True)
+        def kernel(indptr, indices, data, totals, rows, columns, out):
+            for a in range(rows.size):
+                i = rows[a]
+                for b in range(columns.size):
+                    j = columns[b]
+                    distance = 0.0
+                    p, p_end = indptr[i], indptr[i + 1]
+                    q, q_end = indptr[j], indptr[j + 1]
+                    while p < p_end and q < q_end:
+                        if indices[p] == indices[q]:
+                            distance += abs(data[p] - data[q]) / (data[p] + data[q])
+                            p += 1
+                            q += 1
+                        elif indices[p] < indices[q]:
+                            distance += 1.0
+                            p += 1
+                        else:
+                            distance += 1.0
+                            q += 1
+                    out[a, b] = distance + (p_end - p) + (q_end - q)
+
+    _KERNELS[metric] = kernel
+    return kernel
+
+
+def sample_rows(counts, dtype=np.float64):
+    # Samples x features CSR with sorted indices from a features x samples table
+    rows = sp.csr_matrix(counts.T, dtype=dtype)
+    rows.sort_indices()
+    return rows
+
+
+class SampleMatrix:
+    # The filtered samples x features counts plus the transforms the metrics
+    # share (row totals, presence/absence mask, CLR with a pseudocount). Every
+    # transform is built once, on first use, and reused by every metric.
+
+    def __init__(self, counts, pseudocount: float = PSEUDOCOUNT):
+        self.rows = sample_rows(counts)
+        self.pseudocount = pseudocount
+
+    @property
+    def n_samples(self) -> int:
+        return self.rows.shape[0]
+
+    @cached_property
+    def totals(self) -> np.ndarray:
+        return np.asarray(self.rows.sum(axis=1)).ravel()
+
+    @cached_property
+    def presence(self):
+        presence = self.rows.copy()
+        presence.data = (presence.data > 0).astype(np.float64)
+        return presence
+
+    @cached_property
+    def observed(self) -> np.ndarray:
+        return np.asarray(self.presence.sum(axis=1)).ravel()
+
+    @cached_property
+    def clr(self) -> np.ndarray:
+        # Centered log ratio of the counts + pseudocount. Dense, as every feature
+        # of every sample is nonzero after the pseudocount.
+        logs = np.log(self.rows.toarray() + self.pseudocount)
+        return logs - logs.mean(axis=1, keepdims=True)
+
+    @cached_property
+    def clr_norms(self) -> np.ndarray:
+        return np.einsum('ij,ij->i', self.clr, self.clr)
+
+    def prepare(self, metrics) -> None:
+        # Build the transforms the metrics need up front, before the threads share them
+        self.totals
+        if 'jaccard' in metrics:
+            self.observed
+        if 'aitchison' in metrics:
+            self.clr_norms
+
+
+def _sparse_strip(matrix: SampleMatrix, metric: str, block, columns, dtype):
+    rows = matrix.rows
+    if HAVE_NUMBA:
+        out = np.empty((block.size, columns.size), dtype=dtype)
+        _sparse_kernel(metric)(rows.indptr, rows.indices, rows.data, matrix.totals, block, columns, out)
+        return out
+    dense = rows[block].toarray()
+    out = np.empty((block.size, columns.size), dtype=dtype)
+    # Compare against the later samples a block at a time to bound the dense copies
+    for start in range(0, columns.size, BLOCK_SIZE):
+        chunk = columns[start:start + BLOCK_SIZE]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            out[:, start:start + chunk.size] = np.nan_to_num(cdist(dense, rows[chunk].toarray(), metric))
+    return out
+
+
+def _jaccard_strip(matrix: SampleMatrix, block, columns, dtype):
+    # Shared features from one sparse product of the presence masks
+    shared = (matrix.presence[block] @ matrix.presence[columns].T).toarray()
+    union = matrix.observed[block][:, None] + matrix.observed[columns][None, :] - shared
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(union > 0, 1 - shared / union, 0).astype(dtype)
+
+
+def _aitchison_strip(matrix: SampleMatrix, block, columns, dtype):
+    # Euclidean distance between CLR rows, |a|^2 + |b|^2 - 2ab with one matrix product
+    squared = matrix.clr_norms[block][:, None] + matrix.clr_norms[columns][None, :] \
+        - 2 * matrix.clr[block] @ matrix.clr[columns].T
+    distances = np.sqrt(np.maximum(squared, 0)).astype(dtype)
+    # The expansion leaves rounding noise where a sample meets itself, keep the matrix hollow
+    distances[block[:, None] == columns[None, :]] = 0
+    return distances
+
+
+def distance_strip(matrix: SampleMatrix, metric: str, block, columns, dtype=np.float64):
+    # Distances between the samples of `block` and the samples in `columns`
+    if metric == 'jaccard':
+        return _jaccard_strip(matrix, block, columns, dtype)
+    if metric == 'aitchison':
+        return _aitchison_strip(matrix, block, columns, dtype)
+    if metric in ('braycurtis', 'canberra'):
+        return _sparse_strip(matrix, metric, block, columns, dtype)
+    raise ValueError(f"Unknown beta metric: {metric} (choose from {', '.join(METRICS)})")
+
+
+def condensed_offset(row: int, n: int) -> int:
+    # Position of (row, row + 1) in a condensed (upper triangle) distance vector
+    return n * row - row * (row + 1) // 2
+
+
+def allocate_distances(n: int, dtype=np.float32, condensed: bool = False, path: str = None):
+    # Square (n x n) or condensed (n * (n - 1) / 2) output, memory mapped when a path is given
+    shape = (n * (n - 1) // 2,) if condensed else (n, n)
+    if path:
+        return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+    return np.zeros(shape, dtype=dtype)
+
+
+def _write_block(out, strip, block, start, n, condensed):
+    if condensed:
+        # Every row of the upper triangle is a contiguous slice
+        for a, row in enumerate(block):
+            offset = condensed_offset(row, n)
+            out[offset:offset + n - row - 1] = strip[a, a + 1:]
+    else:
+        out[block[0]:block[-1] + 1, start:] = strip
+        out[start:, block[0]:block[-1] + 1] = strip.T
+
+
+def distance_matrices(matrix: SampleMatrix, metrics, dtype=np.float32, condensed: bool = False,
+                      paths: dict = None, block_size: int = BLOCK_SIZE, workers: int = None) -> dict:
+    # Every requested metric between every sample of the matrix. The row blocks of
+    # all metrics go to one thread pool, each block compares its samples with
+    # every later sample and is written straight into that metric's output, so
+    # no full float64 copy is ever held. With a path for a metric its square or
+    # condensed matrix goes to a memory mapped .npy that can be reopened with
+    # np.load(path, mmap_mode='r'). Samples without counts are 0 apart.
+    metrics = list(metrics)
+    unknown = [metric for metric in metrics if metric not in METRICS]
+    if unknown:
+        raise ValueError(f"Unknown beta metric(s): {', '.join(unknown)} (choose from {', '.join(METRICS)})")
+    paths = paths or {}
+    matrix.prepare(metrics)
+    n = matrix.n_samples
+    outputs = {metric: allocate_distances(n, dtype, condensed, paths.get(metric)) for metric in metrics}
+
+    def run_block(task):
+        metric, start = task
+        block = np.arange(start, min(start + block_size, n))
+        strip = distance_strip(matrix, metric, block, np.arange(start, n), dtype)
+        _write_block(outputs[metric], strip, block, start, n, condensed)
+        return block.size
+
+    tasks = [(metric, start) for metric in metrics for start in range(0, n, block_size)]
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        list(pool.map(run_block, tasks))
+
+    for metric, out in outputs.items():
+        if paths.get(metric):
+            out.flush()
+    return outputs
+
+
+def braycurtis(counts, dtype=np.float32, condensed: bool = False, path: str = None,
+               block_size: int = BLOCK_SIZE, workers: int = None):
+    # Bray-Curtis distances between every sample (column) of a sparse features x samples count matrix
+    return distance_matrices(SampleMatrix(counts), ['braycurtis'], dtype, condensed,
+                             {'braycurtis': path}, block_size, workers)['braycurtis']
+
+
+def save_sample_ids(path: str, samples) -> str:
+    # Sample order of a saved matrix, one id per line next to the .npy
+    ids_path = f'{os.path.splitext(path)[0]}_samples.txt'
+    with open(ids_path, 'w') as f:
+        f.write('\n'.join(str(sample) for sample in samples) + '\n')
+    return ids_path
+
+
+def load_distances(path: str, mode: str = 'r'):
+    # Memory mapped matrix plus its sample ids, written by distance_matrices + save_sample_ids
+    with open(f'{os.path.splitext(path)[0]}_samples.txt') as f:
+        samples = [line.rstrip('\n') for line in f if line.strip()]
+    return np.load(path, mmap_mode=mode), samples
+
+
+def counts_digest(rows) -> str:
+    # sha256 of a samples x features CSR's counts, independent of its dtype
+    rows = sp.csr_matrix(rows, dtype=np.float64, copy=True)
+    rows.eliminate_zeros()
+    rows.sort_indices()
+    digest = hashlib.sha256()
+    for array in (rows.indptr.astype(np.int64), rows.indices.astype(np.int64), rows.data):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+def save_feature_state(path: str, metric: str, counts, features) -> str:
+    # Metric, feature ids and a digest of the counts (features x samples, in the
+    # saved sample order) a saved matrix was computed from, next to the .npy as
+    # <root>_features.json so update_distances can tell whether it is still valid
+    state_path = f'{os.path.splitext(path)[0]}_features.json'
+    with open(state_path, 'w') as f:
+        json.dump({'metric': metric,
+                   'pseudocount': PSEUDOCOUNT,
+                   'counts': counts_digest(sample_rows(counts)),
+                   'features': [str(feature) for feature in features]}, f)
+    return state_path
+
+
+def load_feature_state(path: str):
+    # State written by save_feature_state, None for matrices saved without one
+    state_path = f'{os.path.splitext(path)[0]}_features.json'
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path) as f:
+        return json.load(f)
+
+
+def grow_distances(path: str, size: int):
+    # Grow a saved square matrix to size x size in place and return it memory
+    # mapped for writing. Every row moves to its wider offset back to front, so
+    # no row is overwritten before it has been moved. The new rows and columns
+    # are left for the caller to fill.
+    with open(path, 'rb+') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+        header = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (size, size)}
+        buffer = io.BytesIO()
+        if version == (1, 0):
+            np.lib.format.write_array_header_1_0(buffer, header)
+        else:
+            np.lib.format.write_array_header_2_0(buffer, header)
+        n = shape[0]
+
+        if len(shape) != 2 or fortran_order or buffer.tell() != offset:
+            # Condensed, Fortran ordered or a header that no longer fits, rewrite the file
+            stored = np.load(path, mmap_mode='r')
+            if stored.ndim != 2:
+                raise ValueError(f"Only square distance matrices can be updated, {path} has shape {stored.shape}")
+            temp_path = f'{path}.{os.getpid()}.tmp.npy'
+            out = np.lib.format.open_memmap(temp_path, mode='w+', dtype=dtype, shape=(size, size))
+            out[:n, :n] = stored
+            out.flush()
+            del out, stored
+            os.replace(temp_path, path)
+            return np.lib.format.open_memmap(path, mode='r+')
+
+        f.truncate(offset + size * size * dtype.itemsize)
+        f.seek(0)
+        f.write(buffer.getvalue())
+
+    flat = np.memmap(path, dtype=dtype, mode='r+', offset=offset, shape=(size * size,))
+    for row in range(n - 1, 0, -1):
+        flat[row * size:row * size + n] = flat[row * n:(row + 1) * n]
+    flat.flush()
+    del flat
+    return np.lib.format.open_memmap(path, mode='r+')
+
+
+def update_distances(path: str, metric: str, counts, features, samples, add=None,
+                     block_size: int = BLOCK_SIZE, workers: int = None):
+    # Append new samples to a matrix saved with save_sample_ids + save_feature_state
+    # without recomputing it. Only the rows of the new samples (new x every sample)
+    # are computed and written into the grown .npy in place.
+    # counts (features x samples, with the given feature and sample ids) must hold
+    # every stored sample, `add` picks the samples to append (default every sample
+    # not stored yet). Raises ValueError when the saved distances would no longer
+    # hold for the table: a stored feature is gone, a stored sample is missing or
+    # its counts changed, a stored sample has counts in a new feature, or (for
+    # aitchison, whose CLR spans every feature) any feature was added.
+    # Returns (matrix memory mapped read only, samples of the matrix).
+    state = load_feature_state(path)
+    if state is None:
+        raise ValueError(f"{path} has no saved feature state, it can not be updated")
+    if state['metric'] != metric or state.get('pseudocount', PSEUDOCOUNT) != PSEUDOCOUNT:
+        raise ValueError(f"{path} holds {state['metric']} distances, not {metric}")
+    stored, stored_samples = load_distances(path)
+    n = len(stored_samples)
+    if stored.shape != (n, n):
+        raise ValueError(f"{path} has shape {stored.shape} but {n} sample ids")
+    dtype = stored.dtype
+    del stored
+
+    features = pd.Index([str(feature) for feature in features])
+    samples = pd.Index([str(sample) for sample in samples])
+    feature_positions = features.get_indexer(state['features'])
+    if (feature_positions < 0).any():
+        raise ValueError(f"{int((feature_positions < 0).sum())} feature(s) of {path} are no longer in the table")
+    extra = np.setdiff1d(np.arange(len(features)), feature_positions)
+    if metric == 'aitchison' and extra.size:
+        raise ValueError(f"{extra.size} new feature(s) change the CLR of every sample in {path}")
+    stored_positions = samples.get_indexer(stored_samples)
+    if (stored_positions < 0).any():
+        raise ValueError(f"{int((stored_positions < 0).sum())} sample(s) of {path} are no longer in the table")
+
+    counts = sp.csr_matrix(counts)
+    if counts_digest(sample_rows(counts[feature_positions][:, stored_positions])) != state['counts']:
+        raise ValueError(f"The counts of the samples in {path} changed since it was computed")
+    if extra.size and counts[extra][:, stored_positions].count_nonzero():
+        raise ValueError(f"Samples of {path} have counts in features added since it was computed")
+
+    stored_index = pd.Index(stored_samples)
+    add = samples if add is None else pd.Index([str(sample) for sample in add])
+    add = add[~add.isin(stored_index)].unique()
+    if (missing := samples.get_indexer(add) < 0).any():
+        raise ValueError(f"{int(missing.sum())} sample(s) to add are not in the table")
+
+    order = np.concatenate([feature_positions, extra])
+    columns = np.concatenate([stored_positions, samples.get_indexer(add)])
+    combined = counts[order][:, columns]
+    if add.size:
+        matrix = SampleMatrix(combined)
+        matrix.prepare([metric])
+        size = matrix.n_samples
+        out = grow_distances(path, size)
+
+        def run_block(start):
+            block = np.arange(start, min(start + block_size, size))
+            strip = distance_strip(matrix, metric, block, np.arange(size), dtype)
+            # Whole rows of the new samples, their columns only for the stored rows
+            out[block[0]:block[-1] + 1, :] = strip
+            out[:n, block[0]:block[-1] + 1] = strip[:, :n].T
+            return block.size
+
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+            list(pool.map(run_block, range(n, size, block_size)))
+        out.flush()
+        del out
+
+    samples = list(stored_samples) + list(add)
+    save_sample_ids(path, samples)
+    save_feature_state(path, metric, combined, features[order])
+    return np.load(path, mmap_mode='r'), samples
@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+
+def treatment_labels(column: pd.Series) -> pd.Series:
+    # Metadata values as treatment labels, whole numbers of a numeric column
+    # without the trailing '.0' (7.0 -> '7') so they read like the map file
+    column = column.dropna()
+    if pd.api.types.is_numeric_dtype(column):
+        values = column.astype(np.float64)
+        return pd.Series(np.where(values == np.round(values), values.round().astype(np.int64).astype(str),
+                                  values.astype(str)), index=column.index)
+    return column.astype(str)
+
+
+def treatment_mapping(map_file, data_column: str, treatments: list) -> pd.Series:
+    # Build the sample -> treatment mapping once from the map file instead of
+    # running a Metadata.get_ids query per treatment.
+    # Only samples labelled with one of the requested treatments are kept.
+    # Numeric columns are compared by value like the old get_ids query ('7' and
+    # '7.0' both match 7), every sample is labelled with the requested spelling.
+    column = map_file.get_column(f"{data_column}").to_series().dropna()
+    treatments = [str(t) for t in treatments]
+    if pd.api.types.is_numeric_dtype(column):
+        requested = pd.to_numeric(pd.Series(treatments, dtype=object), errors='coerce')
+        labels = {value: treatment for value, treatment in zip(requested, treatments) if not np.isnan(value)}
+        mapping = column.astype(np.float64).map(labels).dropna().astype(str)
+    else:
+        column = column.astype(str)
+        mapping = column[column.isin(treatments)]
+    mapping.index.name = 'samples'
+    return mapping
+
+
+def report_missing(mapping: pd.Series, sample_ids) -> pd.Series:
+    # Drop (and report) samples that are in the map file but not in the table
+    missing = mapping.index.difference(pd.Index(sample_ids, dtype=object), sort=False)
+    for sample in missing:
+        print(f"{sample} is not in the ASV table, please check raw counts file for this sequence run")
+    return mapping.drop(missing)
+
+
+def indicator_matrix(sample_positions, group_codes, n_samples: int, n_groups: int):
+    # Sparse samples x groups matrix with a 1 where a sample belongs to a group,
+    # so counts @ indicator sums every group in a single multiply
+    sample_positions = np.asarray(sample_positions)
+    return sp.csr_matrix((np.ones(len(sample_positions), dtype=np.int64),
+                          (sample_positions, np.asarray(group_codes))),
+                         shape=(n_samples, n_groups))
+
+
+def group_sum(table, mapping: pd.Series, treatments: list):
+    # Per treatment totals for a SparseFeatureTable, returns (features x treatments, labels)
+    mapping = report_missing(mapping, table.samples)
+    positions, _ = table.sample_positions(mapping.index)
+    codes = pd.Categorical(mapping.to_numpy(), categories=treatments).codes
+    indicator = indicator_matrix(positions, codes, table.shape[1], len(treatments))
+    grouped = table.counts.astype(np.int64) @ indicator
+    return grouped.tocsc(), [f'{t}' for t in treatments]
+
+
+def split_replicates(table, mapping: pd.Series, treatments: list):
+    # Keep every replicate as a column, ordered by treatment and relabelled as
+    # '<treatment>_<sample>', returns (features x replicates, labels)
+    mapping = report_missing(mapping, table.samples)
+    order = pd.Categorical(mapping.to_numpy(), categories=treatments).argsort(kind='stable')
+    mapping = mapping.iloc[order]
+    positions, _ = table.sample_positions(mapping.index)
+    labels = (mapping + '_' + mapping.index.to_series()).to_list()
+    return table.counts[:, positions].tocsc(), labels
+
+
+def group_frame(table: pd.DataFrame, mapping: pd.Series, treatments: list) -> pd.DataFrame:
+    # group_sum for a dense (features x samples) DataFrame such as a biom txt table
+    mapping = report_missing(mapping, table.columns)
+    codes = pd.Categorical(mapping.to_numpy(), categories=treatments).codes
+    values = table[mapping.index].to_numpy()
+    indicator = np.zeros((len(mapping), len(treatments)), dtype=values.dtype)
+    indicator[np.arange(len(mapping)), codes] = 1
+    grouped = values @ indicator
+    return pd.DataFrame(grouped, index=table.index, columns=[f'{t}' for t in treatments])
+
+
+def group_biom_tsv(table, mapping: pd.Series, treatments: list) -> pd.DataFrame:
+    # group_frame for a BiomTsv handle, every chunk is reduced straight into its
+    # per treatment sums so the full table is never held in memory. Count chunks
+    # are summed as int64, float (relative frequency) chunks as float64.
+    mapping = report_missing(mapping, table.samples)
+    positions = table.samples.get_indexer(mapping.index)
+    codes = pd.Categorical(mapping.to_numpy(), categories=treatments).codes
+    indicator = indicator_matrix(positions, codes, len(table.samples), len(treatments))
+
+    index_list = []
+    sums_list = []
+    for index, counts in table.chunks():
+        index_list.append(index)
+        sums_list.append((indicator.T @ counts.T.astype(np.int64 if counts.dtype.kind == 'i' else np.float64)).T)
+
+    grouped = np.vstack(sums_list) if sums_list else np.zeros((0, len(treatments)), dtype=np.int64)
+    index = index_list[0].append(index_list[1:]) if index_list else pd.Index([])
+    return pd.DataFrame(grouped, index=index, columns=[f'{t}' for t in treatments])
@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+
+class SparseFeatureTable:
+    # Feature table kept in its sparse form (features x samples CSR) so we never
+    # build the dense float64 DataFrame that Artifact.view(pd.DataFrame) returns.
+    # Counts are stored as int32 and the feature/sample ids as categorical indexes.
+
+    def __init__(self, counts, features, samples):
+        self.counts = sp.csr_matrix(counts)
+        self.features = pd.CategoricalIndex(features, name='features')
+        self.samples = pd.CategoricalIndex(samples, name='samples')
+
+    @classmethod
+    def from_biom(cls, table, dtype=np.int32):
+        counts = table.matrix_data.tocsr()
+        if np.issubdtype(np.dtype(dtype), np.integer):
+            # Frequency tables hold whole counts stored as floats
+            counts.data = np.rint(counts.data)
+        counts = counts.astype(dtype)
+        counts.eliminate_zeros()
+        return cls(counts,
+                   table.ids(axis='observation'),
+                   table.ids(axis='sample'))
+
+    @classmethod
+    def from_artifact(cls, artifact, dtype=np.int32):
+        # biom ships with qiime2, so only import it when reading an artifact
+        import biom
+        return cls.from_biom(artifact.view(biom.Table), dtype=dtype)
+
+    @property
+    def shape(self):
+        return self.counts.shape
+
+    def sample_positions(self, sample_ids):
+        # Column positions for the given ids plus the ids missing from the table
+        sample_ids = list(sample_ids)
+        positions = self.samples.get_indexer(sample_ids)
+        missing = [sample_ids[i] for i in np.flatnonzero(positions < 0)]
+        return positions[positions >= 0], missing
+
+
+def densify_rows(matrix, rows, index, columns) -> pd.DataFrame:
+    # Only densify the selected rows (i.e. the top N slice) of a sparse matrix
+    return pd.DataFrame(matrix[rows].toarray(), index=index, columns=columns)
+
+
+class BiomTsv:
+    # Handle on a classic biom txt (TSV) export that is read in chunks instead of
+    # loading the whole file. Only the header is read up front.
+    # Counts are parsed with explicit float64 dtypes per chunk (biom convert writes
+    # '12.0') and stored as int32 when every value is a whole number, chunks of a
+    # relative frequency export keep their float64 values. The taxonomy column
+    # (if any) is read as a categorical.
+
+    def __init__(self, path: str, chunksize: int = 50000):
+        self.path = path
+        self.chunksize = chunksize
+        header = pd.read_table(path, comment='~', sep="\t", skiprows=1, nrows=0)
+        self.index_column = header.columns[0]
+        self.metadata_columns = [c for c in header.columns[1:] if c.lower() == 'taxonomy']
+        self.samples = pd.Index([c for c in header.columns[1:] if c not in self.metadata_columns])
+
+    def chunks(self):
+        dtypes = {sample: np.float64 for sample in self.samples}
+        dtypes.update({column: 'category' for column in self.metadata_columns})
+        dtypes[self.index_column] = str
+        reader = pd.read_table(self.path, comment='~', sep="\t", skiprows=1,
+                               dtype=dtypes, index_col=self.index_column,
+                               chunksize=self.chunksize)
+        for chunk in reader:
+            chunk.index.name = None
+            counts = chunk[self.samples].fillna(0).to_numpy()
+            if np.array_equal(np.rint(counts), counts):
+                counts = counts.astype(np.int32)
+            yield chunk.index, counts
@@ -0,0 +1,34 @@
+#Principal coordinates of a distance matrix
+import numpy as np
+from skbio import DistanceMatrix
+from skbio.stats.ordination import pcoa
+
+
+def ordinate(distance_matrix, dimensions: int = None, ids=None):
+    # Full eigendecomposition (like qiime2's pcoa) unless only the first
+    # `dimensions` axes are needed, then skbio's randomized fsvd which only
+    # computes those axes. The distance matrix itself is left untouched.
+    # A plain (float32 or memory mapped) square array with its sample ids is
+    # always copied into a float64 skbio DistanceMatrix for the PCoA, which
+    # centers that private copy in place (never the caller's saved matrix); it
+    # is hollow and symmetric by construction, so the O(N^2) validation is skipped.
+    inplace = False
+    if not isinstance(distance_matrix, DistanceMatrix):
+        distance_matrix = DistanceMatrix(np.array(distance_matrix, dtype=np.float64, copy=True), ids=ids, validate=False)
+        inplace = True
+    if dimensions:
+        dimensions = min(dimensions, distance_matrix.shape[0])
+        return pcoa(distance_matrix, method='fsvd', number_of_dimensions=dimensions, inplace=inplace)
+    return pcoa(distance_matrix, inplace=inplace)
+
+
+def captured_variance(ordination) -> float:
+    # Fraction of the eigenvalue sum held by the computed axes. proportion_explained
+    # is taken over every eigenvalue (the trace of the centered matrix for fsvd),
+    # so it is 1 for a full decomposition and below 1 when axes were skipped.
+    return float(ordination.proportion_explained.sum())
+
+
+def axis_label(ordination, axis: int) -> str:
+    # 'Axis 1 [23.45%]' style label, percent of the full eigenvalue sum
+    return f'Axis {axis + 1} [{ordination.proportion_explained.iloc[axis]:.2%}]'
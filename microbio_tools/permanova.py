@@ -0,0 +1,267 @@
+#PERMANOVA, ANOSIM and PERMDISP on index arrays into one shared distance matrix
+import os
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import scipy.stats as stats
+
+from microbio_tools.batch import run_shared, shared_state
+from microbio_tools.significance import fdr_correct
+
+# Permutations evaluated together as one matrix product, batches double up to the max
+PERMUTATION_BATCH = 128
+MAX_PERMUTATION_BATCH = 1024
+
+# Adaptive testing: every test gets at least MIN_PERMUTATIONS and at most
+# MAX_PERMUTATIONS, and stops once the p value is confidently on one side of alpha
+MIN_PERMUTATIONS = 99
+MAX_PERMUTATIONS = 100000
+# Error allowed for each stopping decision (Clopper-Pearson interval on the hit rate)
+STOP_ERROR = 0.001
+
+# Working memory a batch of permutations may use per statistic, larger batches
+# are scored in chunks of permutations that fit
+BATCH_BYTES = 256 * 1024 ** 2
+# Up to this many groups the within group sums are a one-hot matrix product
+# (BLAS, O(n^2 * groups) per permutation), above it the pair labels are compared
+# (O(n^2) per permutation whatever the number of groups)
+ONEHOT_MAX_GROUPS = 64
+
+
+def group_codes(ids, mapping: pd.Series, treatments) -> np.ndarray:
+    # Treatment position of every sample of the distance matrix, -1 when unmapped
+    ids = pd.Index([str(sample) for sample in ids])
+    return pd.Categorical(mapping.reindex(ids), categories=list(treatments)).codes.astype(np.int64)
+
+
+# Tests run on the same permutation batches
+GROUP_TESTS = ('permanova', 'anosim', 'permdisp')
+
+
+def within_sums(matrix, labels: np.ndarray, n_groups: int) -> np.ndarray:
+    # Sum of a symmetric matrix over the pairs inside every group (each pair once)
+    # for every row of labels: (n_perms, n_groups)
+    n_perms, n = labels.shape
+    sums = np.empty((n_perms, n_groups))
+    if n_groups <= ONEHOT_MAX_GROUPS:
+        # G.T @ M @ G for a chunk of permutations at once, the chunk's one-hot
+        # matrix and its product with M fit BATCH_BYTES
+        chunk = max(1, BATCH_BYTES // (16 * n * n_groups))
+        for start in range(0, n_perms, chunk):
+            block = labels[start:start + chunk]
+            onehot = np.zeros((n, block.shape[0] * n_groups))
+            onehot[np.arange(n)[:, None], block.T + np.arange(block.shape[0]) * n_groups] = 1
+            totals = (onehot * (matrix @ onehot)).sum(axis=0) / 2
+            sums[start:start + block.shape[0]] = totals.reshape(-1, n_groups)
+        return sums
+
+    first, second = np.triu_indices(n, k=1)
+    values = matrix[first, second]
+    for row, permutation in enumerate(labels):
+        left = permutation[first]
+        same = left == permutation[second]
+        sums[row] = np.bincount(left[same], weights=values[same], minlength=n_groups)
+    return sums
+
+
+def pseudo_f(squared, labels: np.ndarray, n_groups: int) -> np.ndarray:
+    # PERMANOVA pseudo-F for every row of labels from the squared distances of the samples
+    n = squared.shape[0]
+    # Every pair is counted twice in the full symmetric matrix
+    total = squared.sum() / 2 / n
+    # Shuffling the labels never changes the group sizes
+    sizes = np.bincount(labels[0], minlength=n_groups)
+    within = (within_sums(squared, labels, n_groups) / np.maximum(sizes, 1)).sum(axis=1)
+    return ((total - within) / (n_groups - 1)) / (within / (n - n_groups))
+
+
+def settled(hits: int, permutations: int, alpha: float, error: float = STOP_ERROR) -> bool:
+    # True once the Clopper-Pearson interval of the hit rate lies entirely above
+    # or below alpha, i.e. more permutations will not move the p value across it
+    low = stats.beta.ppf(error / 2, hits, permutations - hits + 1) if hits else 0.0
+    high = stats.beta.ppf(1 - error / 2, hits + 1, permutations - hits) if hits < permutations else 1.0
+    return high < alpha or low > alpha
+
+
+def permutation_tests(statistics: dict, labels: np.ndarray, rng: np.random.Generator, permutations: int = None,
+                      alpha: float = 0.05, min_permutations: int = MIN_PERMUTATIONS,
+                      max_permutations: int = MAX_PERMUTATIONS) -> dict:
+    # Permutation p values of one or more statistics of the same grouping.
+    # statistics maps a test name to fn(labels batch) -> statistic of every row,
+    # larger meaning more extreme. Every batch of shuffled labels is shared by
+    # all the tests still running. With a fixed number of permutations every
+    # test uses exactly that many, otherwise each test stops as soon as its p
+    # value is settled against alpha (or at max_permutations).
+    # Returns {name: {'statistic', 'p-value', 'permutations'}}, p values are
+    # (hits + 1) / (permutations + 1) like skbio.
+    observed = {name: fn(labels[None, :])[0] for name, fn in statistics.items()}
+    hits = dict.fromkeys(statistics, 0)
+    used = dict.fromkeys(statistics, 0)
+    limit = permutations if permutations is not None else max_permutations
+    running = set(statistics) if limit > 0 else set()
+
+    batch = PERMUTATION_BATCH
+    while running:
+        size = min(batch, limit - min(used[name] for name in running))
+        shuffled = rng.permuted(np.broadcast_to(labels, (size, labels.size)), axis=1)
+        for name in list(running):
+            hits[name] += int((statistics[name](shuffled) >= observed[name]).sum())
+            used[name] += size
+            done = used[name] >= limit
+            if permutations is None and used[name] >= min_permutations:
+                done = done or settled(hits[name], used[name], alpha)
+            if done:
+                running.discard(name)
+        batch = min(batch * 2, MAX_PERMUTATION_BATCH)
+
+    return {name: {'statistic': observed[name],
+                   'p-value': (hits[name] + 1) / (used[name] + 1) if used[name] else np.nan,
+                   'permutations': used[name]}
+            for name in statistics}
+
+
+def distance_ranks(distances) -> np.ndarray:
+    # Square matrix of the ranks of the pairwise distances (ties averaged), 0 on the diagonal
+    distances = np.asarray(distances)
+    n = distances.shape[0]
+    upper = np.triu_indices(n, k=1)
+    ranks = np.zeros((n, n))
+    ranks[upper] = stats.rankdata(distances[upper])
+    return ranks + ranks.T
+
+
+def anosim_r(ranks, labels: np.ndarray, n_groups: int) -> np.ndarray:
+    # ANOSIM R = (mean between rank - mean within rank) / (M / 2) for every row of labels
+    n = ranks.shape[0]
+    pairs = n * (n - 1) / 2
+    sizes = np.bincount(labels[0], minlength=n_groups)
+    within = within_sums(ranks, labels, n_groups).sum(axis=1)
+    within_pairs = (sizes * (sizes - 1) / 2).sum()
+    between = (ranks.sum() / 2 - within) / (pairs - within_pairs)
+    return (between - within / within_pairs) / (pairs / 2)
+
+
+def centroid_distances(coordinates: np.ndarray, labels: np.ndarray, n_groups: int) -> np.ndarray:
+    # Euclidean distance of every sample to the centroid of its group in PCoA space,
+    # for every row of labels. The centroids move with the labels, every chunk of
+    # permutations gets its own from one sparse one-hot product.
+    n_perms, n = labels.shape
+    distances = np.empty((n_perms, n))
+    chunk = max(1, BATCH_BYTES // (16 * n * max(coordinates.shape[1], 1)))
+    for start in range(0, n_perms, chunk):
+        block = labels[start:start + chunk]
+        offsets = block + np.arange(block.shape[0])[:, None] * n_groups
+        onehot = sp.csr_matrix((np.ones(offsets.size), (offsets.ravel(), np.tile(np.arange(n), block.shape[0]))),
+                               shape=(block.shape[0] * n_groups, n))
+        sizes = np.bincount(offsets.ravel(), minlength=block.shape[0] * n_groups)
+        centroids = (onehot @ coordinates) / np.maximum(sizes, 1)[:, None]
+        distances[start:start + block.shape[0]] = np.linalg.norm(coordinates[None, :, :] - centroids[offsets], axis=2)
+    return distances
+
+
+def f_statistic(values: np.ndarray, labels: np.ndarray, n_groups: int) -> np.ndarray:
+    # One way ANOVA F of every row of values grouped by the same row of labels
+    n_perms, n = labels.shape
+    offsets = (labels + np.arange(n_perms)[:, None] * n_groups).ravel()
+    sizes = np.bincount(offsets, minlength=n_perms * n_groups).reshape(n_perms, n_groups)
+    sums = np.bincount(offsets, weights=values.ravel(), minlength=n_perms * n_groups).reshape(n_perms, n_groups)
+    grand = values.mean(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        between = np.where(sizes > 0, sizes * (sums / sizes - grand) ** 2, 0).sum(axis=1)
+    within = ((values - grand) ** 2).sum(axis=1) - between
+    return (between / (n_groups - 1)) / (within / (n - n_groups))
+
+
+def permdisp_f(coordinates, labels: np.ndarray, n_groups: int) -> np.ndarray:
+    # PERMDISP F (distances to group centroids) for every row of labels
+    return f_statistic(centroid_distances(coordinates, labels, n_groups), labels, n_groups)
+
+
+def group_tests(distances, members: np.ndarray, labels: np.ndarray, rng: np.random.Generator, coordinates=None,
+                tests=GROUP_TESTS, permutations: int = None, alpha: float = 0.05,
+                max_permutations: int = MAX_PERMUTATIONS, squared=None) -> dict:
+    # PERMANOVA, ANOSIM and PERMDISP of the samples at `members` of the full
+    # (possibly float32 or memory mapped) distances, labels holding their groups
+    # (0..n_groups-1), all scored on the same permutation batches. Only the tested
+    # block is gathered (as float64). squared is np.square(distances) when it is
+    # shared by several tests, otherwise the block is squared here. PERMDISP needs
+    # the PCoA coordinates of every sample and is skipped without them.
+    n_groups = int(labels.max()) + 1
+    block = np.ix_(members, members)
+    statistics = {}
+    if 'permanova' in tests:
+        squares = squared[block] if squared is not None else np.square(distances[block])
+        squares = squares.astype(np.float64, copy=False)
+        statistics['permanova'] = lambda batch: pseudo_f(squares, batch, n_groups)
+    if 'anosim' in tests:
+        ranks = distance_ranks(distances[block])
+        statistics['anosim'] = lambda batch: anosim_r(ranks, batch, n_groups)
+    if 'permdisp' in tests and coordinates is not None:
+        points = np.asarray(coordinates, dtype=np.float64)[members]
+        statistics['permdisp'] = lambda batch: permdisp_f(points, batch, n_groups)
+
+    results = permutation_tests(statistics, labels, rng, permutations, alpha, max_permutations=max_permutations)
+    return {name: dict(result, **{'sample size': labels.size, 'groups': n_groups}) for name, result in results.items()}
+
+
+def permanova(distances, ids, mapping: pd.Series, treatments, permutations: int = None, seed: int = 0,
+              alpha: float = 0.05, max_permutations: int = MAX_PERMUTATIONS, coordinates=None,
+              tests=GROUP_TESTS) -> dict:
+    # Every group test across all treatments, samples outside the treatments are left out.
+    # coordinates are the PCoA coordinates of the samples, in the order of ids.
+    codes = group_codes(ids, mapping, treatments)
+    members = np.flatnonzero(codes >= 0)
+    # Renumber the groups that actually have samples
+    _, labels = np.unique(codes[members], return_inverse=True)
+    if labels.size == 0 or labels.max() == 0:
+        return {}
+    return group_tests(distances, members, labels.ravel(), np.random.default_rng(seed), coordinates,
+                       tests, permutations, alpha, max_permutations)
+
+
+def _pair_test(task) -> dict:
+    # One treatment pair, indexed out of the shared distances and their squares
+    i, j, seed = task
+    distances, squared, coordinates, codes, tests, permutations, alpha, max_permutations = shared_state()
+    members = np.flatnonzero((codes == i) | (codes == j))
+    labels = (codes[members] == j).astype(np.int64)
+    if labels.size == 0 or labels.min() == labels.max():
+        return {}
+    return group_tests(distances, members, labels, np.random.default_rng(seed), coordinates,
+                       tests, permutations, alpha, max_permutations, squared)
+
+
+def pairwise_permanova(distances, ids, mapping: pd.Series, treatments, permutations: int = None,
+                       seed: int = 0, workers: int = None, alpha: float = 0.05,
+                       max_permutations: int = MAX_PERMUTATIONS, coordinates=None,
+                       tests=GROUP_TESTS) -> pd.DataFrame:
+    # Every group test between every pair of treatments. The distances and their
+    # squares are shared with forked workers and every pair only indexes into them. Each pair gets
+    # its own seed spawned from `seed`, so the p values do not depend on the
+    # number of workers. Returns a tidy table, one row per pair and test, with
+    # FDR (Benjamini-Hochberg, per test) q values and the permutations used.
+    treatments = list(treatments)
+    codes = group_codes(ids, mapping, treatments)
+    pairs = [(i, j) for i in range(len(treatments)) for j in range(i + 1, len(treatments))]
+    seeds = np.random.SeedSequence(seed).spawn(len(pairs))
+    tasks = [(i, j, pair_seed) for (i, j), pair_seed in zip(pairs, seeds)]
+    workers = min(workers or os.cpu_count() or 1, max(len(tasks), 1))
+
+    # The distances keep their dtype (and memory mapping), they are squared once for every pair
+    distances = distances if isinstance(distances, np.ndarray) else np.asarray(distances)
+    squared = np.square(distances) if 'permanova' in tests else None
+    state = (distances,
+             squared,
+             None if coordinates is None else np.asarray(coordinates, dtype=np.float64),
+             codes, tests, permutations, alpha, max_permutations)
+    results = run_shared(tasks, _pair_test, state, workers)
+
+    rows = [dict(result, **{'group 1': treatments[i], 'group 2': treatments[j], 'test': name})
+            for (i, j), pair_results in zip(pairs, results) for name, result in pair_results.items()]
+    table = pd.DataFrame(rows, columns=['group 1', 'group 2', 'test', 'sample size',
+                                        'permutations', 'statistic', 'p-value'])
+    table['q-value'] = np.nan
+    for name, test in table.groupby('test').groups.items():
+        table.loc[test, 'q-value'] = fdr_correct(table.loc[test, 'p-value'].to_numpy())
+    return table
@@ -0,0 +1,122 @@
+import os
+import re
+
+import numpy as np
+from matplotlib.colors import to_rgba
+from matplotlib.patches import Patch
+
+FINAL_DPI = 300
+PREVIEW_DPI = 72
+
+
+def save_figure(fig, path: str, preview: bool = False, dpi: int = FINAL_DPI) -> list:
+    # Final export at `dpi`, preview mode first writes a quick low DPI
+    # '<name>_preview.png' next to it. Returns the paths written.
+    paths = []
+    if preview:
+        root, ext = os.path.splitext(path)
+        paths.append(f'{root}_preview{ext or ".png"}')
+        fig.savefig(paths[-1], dpi=PREVIEW_DPI)
+    fig.savefig(path, dpi=dpi)
+    paths.append(path)
+    return paths
+
+
+def stacked_bars(ax, heights, labels, colors, xlabels, width=0.9):
+    # Draw a whole stacked barplot with a single bar call.
+    # heights is a (bars x layers) matrix, the first layer is drawn at the bottom.
+    # Returns legend handles, one per layer, in drawing order.
+    heights = np.asarray(heights, dtype=np.float64)
+    n_bars, n_layers = heights.shape
+    tops = np.cumsum(heights, axis=1)
+    bottoms = tops - heights
+
+    x = np.tile(np.arange(n_bars), n_layers)
+    layer_colors = [to_rgba(color) for color in colors]
+    bar_colors = np.repeat(np.array(layer_colors), n_bars, axis=0)
+
+    ax.bar(x, heights.T.ravel(), bottom=bottoms.T.ravel(), width=width, color=bar_colors)
+    ax.set_xticks(np.arange(n_bars))
+    ax.set_xticklabels(xlabels)
+
+    return [Patch(facecolor=color, label=label) for label, color in zip(labels, layer_colors)]
+
+
+def grouped_boxes(ax, groups, labels, colors, hatches=None, positions=None, width=0.7, medianprops=None):
+    # Draw every group's box with a single boxplot call, then set the face colors,
+    # hatches and flier colors of all the returned artists in one pass.
+    positions = np.arange(len(groups)) if positions is None else np.asarray(positions)
+    hatches = hatches if hatches is not None else [''] * len(groups)
+    colors = [to_rgba(color) for color in colors]
+
+    artists = ax.boxplot(groups,
+                         positions=positions,
+                         patch_artist=True,
+                         medianprops=medianprops,
+                         flierprops=dict(marker='o', markersize=8),
+                         widths=width)
+    for box, flier, color, hatch in zip(artists['boxes'], artists['fliers'], colors, hatches):
+        box.set(facecolor=color, hatch=hatch)
+        flier.set_markerfacecolor(color)
+    ax.set_xticks(positions)
+    ax.set_xticklabels(labels)
+    return artists
+
+
+# Markers picked by the number in a treatment name (or its position)
+MARKERS = [".", "o", "^", "s", "p", "P", "*", "H", "X", "D"]
+# The Tm0/Tm154 scheme the beta plots have always used
+DEFAULT_COLOR_PATTERN = r'Tm(\d+)'
+DEFAULT_COLORS = {'0': 'blue', '154': 'orange'}
+DEFAULT_MARKER_PATTERN = r'T(\d+)'
+
+
+def parse_style_map(values) -> dict:
+    # ['0=blue', '154=orange'] or ['0=blue,154=orange'] -> {'0': 'blue', '154': 'orange'}
+    if not values:
+        return dict(DEFAULT_COLORS)
+    if isinstance(values, str):
+        values = [values]
+    style_map = {}
+    for item in ','.join(values).split(','):
+        key, sep, value = item.partition('=')
+        if not sep or not key.strip() or not value.strip():
+            raise ValueError(f"Invalid color mapping: {item} (expected key=color)")
+        style_map[key.strip()] = value.strip()
+    return style_map
+
+
+def treatment_styles(treatments, color_pattern=DEFAULT_COLOR_PATTERN, colors=None,
+                     marker_pattern=DEFAULT_MARKER_PATTERN, fallback_colors=None):
+    # Color and marker of every treatment. The first group of color_pattern is
+    # looked up in colors, treatments it does not match (or whose key has no
+    # color) use fallback_colors. The first group of marker_pattern picks the
+    # marker when it is a number, otherwise the treatment's position does.
+    colors = DEFAULT_COLORS if colors is None else colors
+    fallback_colors = fallback_colors or {}
+    color_map = {}
+    marker_map = {}
+    for i, treatment in enumerate(treatments):
+        match = re.search(color_pattern, treatment) if color_pattern else None
+        key = (match.group(1) if match.groups() else match.group(0)) if match else None
+        color_map[treatment] = colors.get(key, fallback_colors.get(treatment))
+
+        match = re.search(marker_pattern, treatment) if marker_pattern else None
+        number = (match.group(1) if match.groups() else match.group(0)) if match else ''
+        marker_map[treatment] = MARKERS[(int(number) if number.isdigit() else i) % len(MARKERS)]
+    return color_map, marker_map
+
+
+def grouped_scatter(ax, frame, x, y, group, order, colors: dict, markers: dict, size=150):
+    # One scatter call per group of a (points x columns) frame, in the given order.
+    # Every group is one artist, so the legend needs no de-duplication.
+    handles = []
+    for name, points in frame.groupby(group, sort=False, observed=True):
+        handles.append((order.index(name), ax.scatter(points[x].to_numpy(),
+                                                      points[y].to_numpy(),
+                                                      color=colors.get(name),
+                                                      marker=markers.get(name, 'o'),
+                                                      label=name,
+                                                      s=size,
+                                                      zorder=2)))
+    return [handle for _, handle in sorted(handles, key=lambda item: item[0])]
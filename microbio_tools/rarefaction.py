@@ -0,0 +1,183 @@
+#Repeated rarefaction (subsampling without replacement) of a sparse feature table
+import os
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from microbio_tools.alpha import METRIC_COLUMNS, alpha_metrics
+from microbio_tools.batch import run_shared, shared_state
+
+
+class RunningStats:
+    # Streaming mean/variance of equally shaped arrays (Welford, merged per batch
+    # with Chan's formula) so only the running moments are kept, never the draws.
+    # NaN entries are skipped, every position keeps its own count.
+
+    def __init__(self, shape):
+        self.count = np.zeros(shape)
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+    def update(self, batch: np.ndarray) -> None:
+        # batch has one extra leading axis (the draws) over the tracked shape
+        valid = ~np.isnan(batch)
+        count = valid.sum(axis=0)
+        total = np.where(valid, batch, 0).sum(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.where(count > 0, total / np.maximum(count, 1), 0)
+            m2 = np.where(valid, (batch - mean) ** 2, 0).sum(axis=0)
+            combined = self.count + count
+            delta = mean - self.mean
+            self.mean = np.where(combined > 0, self.mean + delta * count / np.maximum(combined, 1), 0)
+            self.m2 = self.m2 + m2 + delta ** 2 * self.count * count / np.maximum(combined, 1)
+        self.count = combined
+
+    def std(self) -> np.ndarray:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.count > 1, np.sqrt(self.m2 / np.maximum(self.count - 1, 1)), np.nan)
+
+    def result_mean(self) -> np.ndarray:
+        return np.where(self.count > 0, self.mean, np.nan)
+
+
+def rarefaction_depths(totals, max_depth: int, steps: int = 10, min_depth: int = 1) -> np.ndarray:
+    # Evenly spaced depths between min_depth and max_depth (like qiime2's
+    # alpha-rarefaction), capped at the deepest sample
+    max_depth = int(min(max_depth, np.max(totals))) if len(totals) else 0
+    if max_depth < min_depth:
+        return np.empty(0, dtype=np.int64)
+    return np.unique(np.linspace(min_depth, max_depth, num=steps).astype(np.int64))
+
+
+def rarefy(counts, depth: int, draws: int, rng: np.random.Generator):
+    # `draws` subsamples of `depth` reads from every sample (column) with at least
+    # that many reads. Only the nonzero counts of each sample are drawn from, with
+    # one vectorized multivariate hypergeometric call per sample.
+    # Returns (matrix, kept): a features x (kept samples * draws) CSC matrix where
+    # the draws of a sample are adjacent columns, and the kept column positions.
+    counts = sp.csc_matrix(counts)
+    totals = np.asarray(counts.sum(axis=0)).ravel()
+    kept = np.flatnonzero(totals >= depth)
+
+    indices = []
+    data = []
+    lengths = []
+    for column in kept:
+        start, end = counts.indptr[column], counts.indptr[column + 1]
+        colors = counts.data[start:end].astype(np.int64)
+        subsample = rng.multivariate_hypergeometric(colors, depth, size=draws)
+        indices.append(np.tile(counts.indices[start:end], draws))
+        data.append(subsample.ravel())
+        lengths.append(np.full(draws, end - start))
+
+    if not kept.size:
+        return sp.csc_matrix((counts.shape[0], 0)), kept
+    indptr = np.concatenate([[0], np.cumsum(np.concatenate(lengths))])
+    matrix = sp.csc_matrix((np.concatenate(data), np.concatenate(indices), indptr),
+                           shape=(counts.shape[0], kept.size * draws))
+    return matrix, kept
+
+
+def _group_means(values: np.ndarray, codes: np.ndarray, n_groups: int) -> np.ndarray:
+    # values: draws x samples, codes: group of every sample (-1 for ungrouped).
+    # Mean of every group in every draw over the samples with a value, NaN for
+    # groups without any (i.e. pielou_e when every sample has a single taxon).
+    grouped = codes >= 0
+    indicator = sp.csr_matrix((np.ones(grouped.sum()), (np.flatnonzero(grouped), codes[grouped])),
+                              shape=(codes.size, n_groups))
+    valid = ~np.isnan(values)
+    sums = np.asarray(indicator.T.dot(np.where(valid, values, 0).T)).T
+    sizes = np.asarray(indicator.T.dot(valid.T.astype(np.float64))).T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(sizes > 0, sums / sizes, np.nan)
+
+
+def _rarefy_depth(task) -> dict:
+    # Every draw at one depth, reduced batch by batch into running moments per
+    # sample and per group so memory stays bounded by batch_size draws
+    depth, seed = task
+    counts, metrics, codes, n_groups, iterations, batch_size = shared_state()
+    rng = np.random.default_rng(seed)
+    n_samples = counts.shape[1]
+
+    # Samples shallower than the depth are left out of their group
+    deep_enough = np.asarray(counts.sum(axis=0)).ravel() >= depth
+    kept_codes = np.where(deep_enough, codes, -1)
+    sizes = np.bincount(kept_codes[kept_codes >= 0], minlength=n_groups)
+
+    sample_stats = {metric: RunningStats(n_samples) for metric in metrics}
+    group_stats = {metric: RunningStats(n_groups) for metric in metrics}
+    for start in range(0, iterations, batch_size):
+        draws = min(batch_size, iterations - start)
+        matrix, kept = rarefy(counts, depth, draws, rng)
+        results = alpha_metrics(matrix, metrics)
+        for metric in metrics:
+            # Back to draws x samples with NaN for samples shallower than the depth
+            values = np.full((draws, n_samples), np.nan)
+            values[:, kept] = results[METRIC_COLUMNS[metric]].reshape(kept.size, draws).T
+            sample_stats[metric].update(values)
+            group_stats[metric].update(_group_means(values, kept_codes, n_groups))
+
+    return {'depth': depth, 'samples': sample_stats, 'groups': group_stats, 'sizes': sizes}
+
+
+def rarefaction(counts, samples, depths, metrics, mapping: pd.Series = None, treatments=None,
+                iterations: int = 10, seed: int = 0, workers: int = None, batch_size: int = 10, z: float = 1.96):
+    # Repeated rarefaction of a sparse features x samples count matrix at every
+    # depth. Depths run on a forked process pool, each with its own seed spawned
+    # from `seed` so the results do not depend on the number of workers.
+    # Returns (curves, summary):
+    #   curves:  (depth, samples, metric, mean, std, iterations) per sample
+    #   summary: (depth, treatment, metric, mean, ci low, ci high, samples) per
+    #            treatment, the interval spans z standard deviations of the
+    #            treatment mean across the draws
+    metrics = list(metrics)
+    unknown = [metric for metric in metrics if metric not in METRIC_COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown alpha metric(s): {', '.join(unknown)} (choose from {', '.join(METRIC_COLUMNS)})")
+
+    samples = pd.Index(samples, name='samples').astype(str)
+    treatments = list(treatments or [])
+    if mapping is not None:
+        codes = pd.Categorical(mapping.reindex(samples), categories=treatments).codes.astype(np.int64)
+    else:
+        codes = np.full(len(samples), -1)
+
+    depths = [int(depth) for depth in depths]
+    seeds = np.random.SeedSequence(seed).spawn(len(depths))
+    tasks = list(zip(depths, seeds))
+    workers = min(workers or os.cpu_count() or 1, max(len(tasks), 1))
+
+    state = (sp.csc_matrix(counts), metrics, codes, len(treatments), iterations, max(batch_size, 1))
+    results = run_shared(tasks, _rarefy_depth, state, workers)
+
+    curves = []
+    summary = []
+    for result in results:
+        for metric in metrics:
+            sample_stats = result['samples'][metric]
+            curves.append(pd.DataFrame({'depth': result['depth'],
+                                        'samples': samples,
+                                        'metric': metric,
+                                        'mean': sample_stats.result_mean(),
+                                        'std': sample_stats.std(),
+                                        'iterations': sample_stats.count.astype(np.int64)}))
+            group_stats = result['groups'][metric]
+            mean = np.where(result['sizes'] > 0, group_stats.result_mean(), np.nan)
+            spread = z * np.nan_to_num(group_stats.std())
+            summary.append(pd.DataFrame({'depth': result['depth'],
+                                         'treatment': treatments,
+                                         'metric': metric,
+                                         'mean': mean,
+                                         'ci low': mean - spread,
+                                         'ci high': mean + spread,
+                                         'samples': result['sizes']}))
+
+    curves = pd.concat(curves, ignore_index=True) if curves else pd.DataFrame(
+        columns=['depth', 'samples', 'metric', 'mean', 'std', 'iterations'])
+    summary = pd.concat(summary, ignore_index=True) if summary else pd.DataFrame(
+        columns=['depth', 'treatment', 'metric', 'mean', 'ci low', 'ci high', 'samples'])
+    # Samples shallower than a depth carry no values there
+    curves = curves[curves['iterations'] > 0].reset_index(drop=True)
+    return curves, summary
@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+# Ambiguous/unresolved lineages dropped from the top N when filtering is requested
+AMBIGUOUS_TAXA = ["k__Bacteria;Other",
+                  "k__Fungi;Other",
+                  "k__Eukaryota;Other",
+                  "k__Bacteria;p__unclassified_Bacteria",
+                  "k__Fungi;p__unclassified_Fungi",
+                  "k__Eukaryota;p__unclassified_Eukaryota",
+                  "k__Bacteria_OR_k__unclassified_;Other",
+                  "k__Fungi_OR_k__unclassified_;Other",
+                  "k__Eukaryota_OR_k__unclassified_;Other",
+                  "k__Unassigned;Other"]
+
+
+def rank_matrix(values: np.ndarray) -> np.ndarray:
+    # Row positions of each column sorted from most to least abundant.
+    # Mirrors DataFrame.sort_values(ascending=False) (reverse, quicksort, reverse)
+    # so ties come out in the same order as sorting each column separately.
+    values = np.asarray(values, dtype=np.float64)
+    values = np.where(np.isnan(values), -np.inf, values)
+    n_rows = values.shape[0]
+    order = values[::-1].argsort(axis=0, kind='quicksort')
+    return (n_rows - 1 - order)[::-1]
+
+
+def sparse_rank_matrix(matrix) -> np.ndarray:
+    # rank_matrix for a sparse (features x treatments) matrix. Quicksort is not
+    # stable, so ties (zeros included) only come out in sort_values' order when the
+    # whole column is sorted the same way: every column is densified on its own
+    # and ranked with rank_matrix, so only one dense column is held next to the
+    # integer ranks.
+    matrix = sp.csc_matrix(matrix)
+    n_rows, n_cols = matrix.shape
+    ranks = np.empty((n_rows, n_cols), dtype=np.intp)
+    for j in range(n_cols):
+        ranks[:, j] = rank_matrix(matrix[:, j].toarray())[:, 0]
+    return ranks
+
+
+def _walk_ranks(labels, ranks: np.ndarray, num: int, exclude=None) -> list:
+    # Row major order of the rank matrix is exactly the visiting order of the
+    # original round robin loop
+    excluded = set(exclude) if exclude is not None else set()
+    top_taxa = []
+    seen = set()
+    for row in ranks:
+        for taxa in labels[row]:
+            if taxa in seen or taxa in excluded:
+                continue
+            seen.add(taxa)
+            top_taxa.append(taxa)
+            if len(top_taxa) >= num:
+                return top_taxa
+
+    print(f"Warning: Only {len(top_taxa)} taxa available, could not find top {num}")
+    return top_taxa
+
+
+def top_n_taxa(table: pd.DataFrame, num: int, exclude=None) -> list:
+    # Round robin over the treatment columns: take the most abundant taxon of each
+    # column, then the second most abundant of each column and so on, skipping any
+    # taxon already picked (or excluded) until we have N taxa.
+    # The rank matrix is computed once instead of re-sorting the table for every
+    # treatment on every row.
+    if num <= 0 or table.empty:
+        return []
+
+    return _walk_ranks(table.index.to_numpy(), rank_matrix(table.to_numpy()), num, exclude)
+
+
+def top_n_taxa_sparse(matrix, labels, num: int, exclude=None) -> list:
+    # Sparse counterpart of top_n_taxa, returns the row positions of the top N
+    # taxa so the caller can densify just those rows
+    if num <= 0 or matrix.shape[0] == 0 or matrix.shape[1] == 0:
+        return []
+
+    labels = np.asarray(labels, dtype=object)
+    top_taxa = _walk_ranks(labels, sparse_rank_matrix(matrix), num, exclude)
+    positions = pd.Index(labels).get_indexer(top_taxa)
+    return positions.tolist()
@@ -0,0 +1,144 @@
+#Significance testing between treatment groups of a long (treatment, value) table
+import os
+
+import numpy as np
+import pandas as pd
+import scipy.stats as stats
+
+from microbio_tools.batch import run_shared, shared_state
+
+POSTHOC_METHODS = ('dunn', 'mannwhitney')
+
+# Number of pairs above which the Mann-Whitney posthoc goes to a process pool
+POOL_MIN_PAIRS = 2000
+
+
+def group_values(dataframe: pd.DataFrame, group_column: str = 'treatment', value_column: str = 'value'):
+    # Split a long table into (names, [values of each group]), undefined (NaN)
+    # values and groups left empty are dropped
+    names = []
+    values = []
+    for name, group in dataframe.groupby(group_column, observed=True, sort=True):
+        group_values = group[value_column].dropna().to_numpy(dtype=np.float64)
+        if group_values.size:
+            names.append(name)
+            values.append(group_values)
+    return names, values
+
+
+def kruskal_omnibus(values: list) -> tuple:
+    # One Kruskal-Wallis test across every group, (H, p)
+    # A single group, or all values tied, has no defined statistic
+    if len(values) < 2:
+        return np.nan, np.nan
+    try:
+        result = stats.kruskal(*values)
+    except ValueError:
+        return np.nan, np.nan
+    return result.statistic, result.pvalue
+
+
+def pair_indices(n_groups: int):
+    # Upper triangle of the group x group grid, every unordered pair once
+    return np.triu_indices(n_groups, k=1)
+
+
+def dunn_test(values: list):
+    # Dunn's test on all pairs at once from the ranks of the pooled values.
+    # Returns (z, p) arrays in pair_indices order.
+    sizes = np.array([len(v) for v in values], dtype=np.float64)
+    pooled = np.concatenate(values)
+    ranks = stats.rankdata(pooled)
+    codes = np.repeat(np.arange(len(values)), sizes.astype(np.intp))
+    mean_ranks = np.bincount(codes, weights=ranks) / sizes
+
+    n = pooled.size
+    _, ties = np.unique(pooled, return_counts=True)
+    tie_term = (ties ** 3 - ties).sum() / (12 * (n - 1))
+    variance = n * (n + 1) / 12 - tie_term
+
+    i, j = pair_indices(len(values))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = (mean_ranks[i] - mean_ranks[j]) / np.sqrt(variance * (1 / sizes[i] + 1 / sizes[j]))
+    p = 2 * stats.norm.sf(np.abs(z))
+    return z, p
+
+
+def _mannwhitney_chunk(pairs) -> list:
+    values = shared_state()
+    results = []
+    for i, j in pairs:
+        try:
+            test = stats.mannwhitneyu(values[i], values[j], alternative='two-sided')
+            results.append((test.statistic, test.pvalue))
+        except ValueError:
+            results.append((np.nan, np.nan))
+    return results
+
+
+def mannwhitney_test(values: list, workers: int = None):
+    # Mann-Whitney U on every pair, (U, p) arrays in pair_indices order.
+    # Very large pair counts are chunked over a forked process pool, the grouped
+    # values are inherited by the workers instead of pickled with each chunk.
+    i, j = pair_indices(len(values))
+    pairs = list(zip(i.tolist(), j.tolist()))
+    workers = workers or os.cpu_count() or 1
+    if len(pairs) < POOL_MIN_PAIRS:
+        workers = 1
+
+    chunks = [pairs[k::workers] for k in range(workers)]
+    chunk_results = run_shared(chunks, _mannwhitney_chunk, values, workers)
+    # Undo the round-robin split so the results line up with the pairs
+    results = [None] * len(pairs)
+    for k, chunk in enumerate(chunk_results):
+        results[k::workers] = chunk
+
+    if not results:
+        return np.empty(0), np.empty(0)
+    statistic, p = (np.array(column, dtype=np.float64) for column in zip(*results))
+    return statistic, p
+
+
+def fdr_correct(p_values: np.ndarray) -> np.ndarray:
+    # Benjamini-Hochberg adjusted p values, undefined p values are left out of the correction
+    p_values = np.asarray(p_values, dtype=np.float64)
+    adjusted = np.full(p_values.shape, np.nan)
+    valid = ~np.isnan(p_values)
+    if valid.any():
+        adjusted[valid] = stats.false_discovery_control(p_values[valid], method='bh')
+    return adjusted
+
+
+def significance_tests(dataframe: pd.DataFrame, method: str = 'dunn', alpha: float = 0.05,
+                       workers: int = None, group_column: str = 'treatment', value_column: str = 'value'):
+    # Omnibus Kruskal-Wallis across every group followed by posthoc tests on every
+    # pair with FDR correction. Returns (omnibus, pairs): a one row summary table
+    # and a tidy table with one row per pair of groups.
+    if method not in POSTHOC_METHODS:
+        raise ValueError(f"Unknown posthoc method {method}, choose from {', '.join(POSTHOC_METHODS)}")
+
+    names, values = group_values(dataframe, group_column, value_column)
+    h_value, p_value = kruskal_omnibus(values)
+    omnibus = pd.DataFrame({'test': ['kruskal-wallis'],
+                            'groups': [len(names)],
+                            'samples': [sum(len(v) for v in values)],
+                            'H value': [h_value],
+                            'P value': [p_value]})
+
+    if method == 'dunn':
+        statistic, p = dunn_test(values) if len(values) > 1 else (np.empty(0), np.empty(0))
+        statistic_name = 'Z value'
+    else:
+        statistic, p = mannwhitney_test(values, workers)
+        statistic_name = 'U value'
+
+    i, j = pair_indices(len(names))
+    names = np.asarray(names, dtype=object)
+    q = fdr_correct(p)
+    pairs = pd.DataFrame({'group 1': names[i],
+                          'group 2': names[j],
+                          statistic_name: statistic,
+                          'P value': p,
+                          'Q value': q,
+                          'significant': q < alpha})
+    return omnibus, pairs
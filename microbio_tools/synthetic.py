@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from microbio_tools.loaders import SparseFeatureTable
+
+RANK_PREFIXES = ['k__', 'p__', 'c__', 'o__', 'f__', 'g__']
+
+
+def synthetic_lineages(n_features: int, rng) -> np.ndarray:
+    # Random greengenes style lineages, resolved down to a random depth
+    depth = rng.integers(1, len(RANK_PREFIXES) + 1, size=n_features)
+    names = rng.integers(0, 50, size=(n_features, len(RANK_PREFIXES)))
+    lineages = []
+    for i in range(n_features):
+        ranks = [f'{RANK_PREFIXES[r]}taxon{names[i, r]}' for r in range(depth[i])]
+        ranks += [RANK_PREFIXES[r] for r in range(depth[i], len(RANK_PREFIXES))]
+        # Keep ids unique, like ASV ids would be
+        lineages.append(';'.join(ranks) + f';s__asv{i}')
+    return np.array(lineages, dtype=object)
+
+
+def synthetic_table(n_features: int, n_samples: int, density: float = 0.05, seed: int = 0) -> SparseFeatureTable:
+    # Sparse features x samples count table with a long-tailed abundance
+    # distribution, similar in shape to a real ASV table (mostly zeros)
+    rng = np.random.default_rng(seed)
+    nnz = max(1, int(n_features * n_samples * density))
+    rows = rng.integers(0, n_features, size=nnz)
+    cols = rng.integers(0, n_samples, size=nnz)
+    # A few abundant features and many rare ones
+    scale = rng.pareto(1.5, size=n_features) + 1
+    counts = rng.poisson(scale[rows] * 5) + 1
+    matrix = sp.csr_matrix((counts.astype(np.int32), (rows, cols)), shape=(n_features, n_samples))
+    matrix.sum_duplicates()
+    samples = [f'sample{i}' for i in range(n_samples)]
+    return SparseFeatureTable(matrix, synthetic_lineages(n_features, rng), samples)
+
+
+def synthetic_metadata(samples, n_treatments: int, column: str = 'treatment', seed: int = 0) -> pd.DataFrame:
+    # Map file style frame assigning every sample to one of n treatments
+    rng = np.random.default_rng(seed)
+    treatments = [f'T{i}' for i in range(n_treatments)]
+    labels = [treatments[i] for i in rng.integers(0, n_treatments, size=len(samples))]
+    frame = pd.DataFrame({column: labels}, index=pd.Index([str(s) for s in samples], name='sample-id'))
+    return frame
+
+
+def write_biom_tsv(table: SparseFeatureTable, path: str, chunksize: int = 10000) -> str:
+    # Write the table as a classic biom txt export (what biom convert --to-tsv gives)
+    samples = table.samples.astype(str).to_list()
+    features = table.features.astype(str).to_numpy()
+    with open(path, 'w') as f:
+        f.write('# Constructed from biom file\n')
+        f.write('\t'.join(['#OTU ID'] + samples) + '\n')
+        for start in range(0, table.shape[0], chunksize):
+            block = table.counts[start:start + chunksize].toarray().astype(np.float64)
+            frame = pd.DataFrame(block, index=features[start:start + chunksize])
+            frame.to_csv(f, sep='\t', header=False, float_format='%.1f')
+    return path
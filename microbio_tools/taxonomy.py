@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+
+RANKS = ['kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species']
+# Greengenes style prefixes, SILVA uses d__ for the domain/kingdom level
+RANK_PREFIXES = {'kingdom': ('k__', 'd__'),
+                 'phylum': ('p__',),
+                 'class': ('c__',),
+                 'order': ('o__',),
+                 'family': ('f__',),
+                 'genus': ('g__',),
+                 'species': ('s__',)}
+
+# Labels already worked out, keyed by (lineage, deepest rank allowed)
+_LABEL_CACHE = {}
+
+
+def split_lineages(lineages) -> pd.DataFrame:
+    # Split each lineage string once into a rank-columned categorical frame.
+    # Ranks are positional (k;p;c;o;f;g;s), missing levels are NaN.
+    lineages = pd.Series(lineages, dtype=object).astype(str)
+    parts = lineages.str.split(';', expand=True, n=len(RANKS) - 1)
+    parts = parts.apply(lambda column: column.str.strip())
+    parts.columns = RANKS[:parts.shape[1]]
+    parts = parts.reindex(columns=RANKS)
+    parts.index = lineages.to_numpy()
+    return parts.astype('category')
+
+
+def resolved_ranks(parts: pd.DataFrame) -> pd.DataFrame:
+    # True where a rank carries its own prefix and an actual name (i.e. not 'g__')
+    resolved = {}
+    for rank in RANKS:
+        column = parts[rank].astype(object)
+        has_prefix = column.str.startswith(RANK_PREFIXES[rank], na=False)
+        has_name = column.str.len().fillna(0) > 3
+        resolved[rank] = (has_prefix & has_name).to_numpy()
+    return pd.DataFrame(resolved, index=parts.index)
+
+
+def deepest_labels(lineages, max_rank: str = 'genus') -> list:
+    # Deepest resolved rank of each lineage (down to max_rank), e.g.
+    # 'k__Bacteria;p__Firmicutes;c__Bacilli;o__;f__;g__' -> 'c__Bacilli'.
+    # Lineages without any resolved rank (i.e. 'k__Bacteria;Other' style ones)
+    # fall back to their first level. Only lineages not seen before are parsed,
+    # and those in a single vectorized pass.
+    lineages = [str(lineage) for lineage in lineages]
+    new = pd.unique(pd.Series([lineage for lineage in lineages
+                               if (lineage, max_rank) not in _LABEL_CACHE], dtype=object))
+
+    if len(new) > 0:
+        parts = split_lineages(new)
+        depth = RANKS.index(max_rank) + 1
+        resolved = resolved_ranks(parts).to_numpy()[:, :depth]
+
+        # Index of the last resolved rank, -1 if there is none
+        last = depth - 1 - np.argmax(resolved[:, ::-1], axis=1)
+        last[~resolved.any(axis=1)] = -1
+
+        values = parts.to_numpy(dtype=object)
+        rows = np.arange(len(new))
+        labels = np.where(last >= 0, values[rows, np.maximum(last, 0)], values[:, 0])
+        _LABEL_CACHE.update({(lineage, max_rank): label for lineage, label in zip(new, labels)})
+
+    return [_LABEL_CACHE[(lineage, max_rank)] for lineage in lineages]
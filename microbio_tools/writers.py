@@ -0,0 +1,92 @@
+import importlib.util
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+# Formats written from the DataFrames themselves
+TABLE_FORMATS = ['csv', 'parquet', 'feather', 'xlsx']
+# Formats rendered by the calling script (its markdown/html templates)
+DOCUMENT_FORMATS = ['md', 'html']
+OUTPUT_FORMATS = TABLE_FORMATS + DOCUMENT_FORMATS
+# What the scripts have always written
+DEFAULT_FORMATS = ['xlsx', 'md', 'html']
+
+
+def parse_formats(formats) -> list:
+    # Accept ['csv', 'xlsx'] as well as ['csv,xlsx'] like the other list options
+    if not formats:
+        return list(DEFAULT_FORMATS)
+    if isinstance(formats, str):
+        formats = [formats]
+    parsed = []
+    for fmt in ','.join(formats).split(','):
+        fmt = fmt.strip().lower().lstrip('.')
+        if fmt == 'markdown':
+            fmt = 'md'
+        if fmt not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format: {fmt} (choose from {', '.join(OUTPUT_FORMATS)})")
+        if fmt not in parsed:
+            parsed.append(fmt)
+    return parsed
+
+
+def excel_engine() -> str:
+    # xlsxwriter is a lot faster than openpyxl on wide tables, use it when installed
+    if importlib.util.find_spec('xlsxwriter') is not None:
+        return 'xlsxwriter'
+    return 'openpyxl'
+
+
+def _arrow_safe(table: pd.DataFrame) -> pd.DataFrame:
+    # parquet/feather need string column names and feather a default index
+    table = table.copy()
+    table.columns = [str(c) for c in table.columns]
+    return table
+
+
+def write_table(table: pd.DataFrame, path: str, fmt: str) -> str:
+    if fmt == 'csv':
+        table.to_csv(path)
+    elif fmt == 'xlsx':
+        table.to_excel(path, engine=excel_engine())
+    elif fmt == 'parquet':
+        _arrow_safe(table).to_parquet(path)
+    elif fmt == 'feather':
+        _arrow_safe(table).reset_index().to_feather(path)
+    return path
+
+
+def write_document(render, path: str) -> str:
+    # render is only called on the worker thread, so skipped formats cost nothing
+    with open(path, "w") as f:
+        f.write(render())
+    return path
+
+
+def write_outputs(outputdir: str, tables: dict, documents: dict, formats=None, workers=None) -> list:
+    # tables:    {file name without extension: DataFrame} for csv/parquet/feather/xlsx
+    # documents: {'md'/'html': (file name, render function returning the text)}
+    # Every requested file is written at the same time on a thread pool, formats
+    # that were not requested are skipped.
+    formats = parse_formats(formats)
+
+    tasks = []
+    for fmt in formats:
+        if fmt in TABLE_FORMATS:
+            if fmt in ('parquet', 'feather') and importlib.util.find_spec('pyarrow') is None:
+                print(f"Warning: pyarrow is not installed, skipping {fmt} output")
+                continue
+            for name, table in tables.items():
+                tasks.append((write_table, (table, os.path.join(outputdir, f'{name}.{fmt}'), fmt)))
+        elif fmt in documents:
+            name, render = documents[fmt]
+            tasks.append((write_document, (render, os.path.join(outputdir, name))))
+
+    if not tasks:
+        return []
+
+    print(f"Writing {len(tasks)} output files ({', '.join(formats)})...")
+    with ThreadPoolExecutor(max_workers=workers or len(tasks)) as pool:
+        futures = [pool.submit(func, *task_args) for func, task_args in tasks]
+        return [future.result() for future in futures]
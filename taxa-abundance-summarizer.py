@@ -1,89 +1,43 @@
 import argparse
-import json
 import os
 from datetime import datetime
 
+import matplotlib
+#Figures are only saved to disk, force a non-interactive backend
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
+from matplotlib.colors import to_rgba
 import numpy as np
 import pandas as pd
 from qiime2 import Artifact, Metadata
 from qiime2.plugins import feature_table
 from qiime2.plugins.taxa.visualizers import barplot
 
+from microbio_tools.batch import job_output_dir, load_manifest, run_jobs
+from microbio_tools.colors import load_or_create_color_map
+from microbio_tools.grouping import group_biom_tsv, group_frame, group_sum, treatment_mapping
+from microbio_tools.grouping import split_replicates as split_replicates_columns
+from microbio_tools.loaders import BiomTsv, SparseFeatureTable, densify_rows
+from microbio_tools.plotting import save_figure, stacked_bars
+from microbio_tools.selection import AMBIGUOUS_TAXA
+from microbio_tools.selection import top_n_taxa as select_top_n_taxa
+from microbio_tools.selection import top_n_taxa_sparse as select_top_n_taxa_sparse
+from microbio_tools.taxonomy import deepest_labels
+from microbio_tools.writers import OUTPUT_FORMATS, parse_formats, write_outputs
 
-#To clean up asv labels
-def asv_label_formatter(asv_list):
-    for i in range(len(asv_list)):
-        if 'Other' in asv_list[i] or '__':
-            if 'g__' in asv_list[i]:
-                asv_list[i] = asv_list[i].split(';')[5]
-                
-            elif 'f__' in asv_list[i]:
-                asv_list[i] = asv_list[i].split(';')[4]
-                
-            elif 'o__' in asv_list[i]:
-                asv_list[i] = asv_list[i].split(';')[3]
-                
-            elif 'c__' in asv_list[i]:
-                asv_list[i] = asv_list[i].split(';')[2]
-                
-            elif 'p__' in asv_list[i]:
-                asv_list[i] = asv_list[i].split(';')[1]
-            else:
-                asv_list[i] = asv_list[i].split(';')[0]
-        else:
-            asv_list[i]=asv_list[i].split(';')[-1]
-
-def load_or_create_color_map(headers, outputdir):
-    color_file = os.path.join(outputdir, 'color_map.json')
-
-    color_map = {}
-    if os.path.exists(color_file):
-        print("Loading existing color map...")
-        with open(color_file, 'r') as f:
-            color_map = json.load(f)
-
-    cmap = plt.get_cmap('tab20')
-    all_colors = [cmap(i) for i in range(cmap.N)]
-
-    color_index = len(color_map)
-
-    for taxon in headers:
-        if taxon not in color_map:
-            if color_index >= len(all_colors):
-                print(f"Warning: Not enough colors for all taxons, reusing colors")
-                color_index = color_index % len(all_colors)
-
-            color_map[taxon] = all_colors[color_index]
-            color_index += 1
-
-    with open(color_file, 'w') as f:
-        json.dump(color_map, f, indent=None, separators=(',', ':'))
-
-    print("Color map loaded successfully")
-
-    return color_map
-        
-    
 
-def visualizer(top_taxa_table, plot_title, outputdir):
+def visualizer(top_taxa_table, plot_title, outputdir, preview: bool = False):
     treatment_total=top_taxa_table[top_taxa_table.columns].sum(axis=1)
     
     print('Values to be used to normalize')
     print(treatment_total)
     
-    #Normalize values
-    top_taxa_table=top_taxa_table.div(treatment_total,axis=0)
-    print("Normalizing table...")
-    print(top_taxa_table.T)
-    
-    top_taxa_table=top_taxa_table[top_taxa_table.columns].multiply(100,axis=0)
+    #Normalize values and calculate percentages in one go
+    top_taxa_table=top_taxa_table.div(treatment_total,axis=0).multiply(100)
     print("Calculating percentage...")
     print(top_taxa_table.T)
     
-    
-        
     headers = top_taxa_table.columns.to_list()
     
     fig, ax = plt.subplots(figsize = (15, 10))
@@ -94,35 +48,35 @@ def visualizer(top_taxa_table, plot_title, outputdir):
     color_map = load_or_create_color_map(headers, outputdir)
     colors = [color_map[taxon] for taxon in headers]
     
-    #Plot the "Other" column first.
-    ax.bar(top_taxa_table.index, top_taxa_table["Other"], bottom=0, width=0.9, color='black', alpha=0.77, label='Other')
-    current = top_taxa_table['Other']
-    
-    headers.pop(len(headers)-1)
-    i=len(headers)-1
+    #Layers from bottom to top: "Other" first, then top N ASVs from least abundant to most
+    # *"Other" is always the last column of the table
+    layers = [len(headers)-1] + list(range(len(headers)-2, -1, -1))
+    layer_labels = ['Other'] + [headers[i] for i in layers[1:]]
+    layer_colors = [to_rgba('black', 0.77)] + [colors[i] for i in layers[1:]]
     
-    #Loop through top N ASVs and plot them according to least abundant to most
-    while i >= 0:
-        ax.bar(top_taxa_table.index, top_taxa_table[headers[i]], bottom=current, width=0.9, label=headers[i], color=colors[i])
-        current+=top_taxa_table[headers[i]]
-        i-=1
+    #Draw every layer of every bar with a single call from the stacked matrix
+    handles = stacked_bars(ax,
+                           top_taxa_table.to_numpy()[:, layers],
+                           layer_labels,
+                           layer_colors,
+                           top_taxa_table.index.to_list())
     
     #Settings for barplot
     plt.xticks(rotation=90,fontsize='15')
     plt.yticks(fontsize='15')
     plt.ylabel("Relative Abundance %", fontsize='15')
-    handles, labels = plt.gca().get_legend_handles_labels()
-    labels.reverse()
+    
+    #Most abundant ASV on top of the legend, "Other" at the bottom
     handles.reverse()
 
 
     #https://stackoverflow.com/questions/15637961/matplotlib-alignment-of-legend-title
     #https://stackoverflow.com/questions/4700614/how-to-put-the-legend-outside-the-plot
-    ax.legend(handles, labels, bbox_to_anchor=(1, 1), frameon=False, title="ASV", alignment='left')
+    ax.legend(handles=handles, bbox_to_anchor=(1, 1), frameon=False, title="ASV", alignment='left')
 
     #https://stackoverflow.com/questions/12402561/how-to-set-font-size-of-matplotlib-axis-legend
-    plt.setp(plt.gca().get_legend().get_texts(), fontsize='15')
-    plt.setp(plt.gca().get_legend().get_title(),fontsize='20')
+    plt.setp(ax.get_legend().get_texts(), fontsize='15')
+    plt.setp(ax.get_legend().get_title(),fontsize='20')
     #https://matplotlib.org/stable/gallery/text_labels_and_annotations/titles_demo.html
     ax.set_title(f"{plot_title}",fontsize='20')
 
@@ -131,9 +85,10 @@ def visualizer(top_taxa_table, plot_title, outputdir):
     ax.spines['right'].set_visible(False)
     fig.tight_layout()
     print("Saving visualization...")
-    fig.savefig(f'{outputdir}{plot_title}.png', dpi=300)
+    print(f"Saved {', '.join(save_figure(fig, f'{outputdir}{plot_title}.png', preview))}")
+    plt.close(fig)
 
-def stats_generator(asv_table: pd.DataFrame, outputdir: str, method:str, raw_asv_strings: list):
+def stats_generator(asv_table: pd.DataFrame, outputdir: str, method:str, raw_asv_strings: list, formats=None):
     time_generated=datetime.now().strftime("%d/%m/%y %H:%M:%S")
     
     #Normalize results
@@ -142,17 +97,13 @@ def stats_generator(asv_table: pd.DataFrame, outputdir: str, method:str, raw_asv
     
     asv_table.index = raw_asv_strings
     
-    print('Generating excel file...')
-    asv_table.T.to_excel(f'{outputdir}top_n_stats.xlsx')
-    
     asv_table_normalized=asv_table.multiply(100, axis=1)
-    print('Generating markdown file with table stats...')
-    with open(f'{outputdir}top_n_stats.md', "w") as f:
-        f.write(f'''# Top N stats\n## Method used: {method}\n## To find further sequence specific information, refer to table 03 generated previously\n**Please refer to the excel or csv file generated to perform further analysis.**\nDate file was generated: {time_generated}\n{asv_table_normalized.to_markdown()}''')
     
-    print('Generating html file with table stats...')
-    with open(f'{outputdir}top_n_stats.html', "w") as f:
-        f.write(f'''<!doctype html>
+    def markdown():
+        return f'''# Top N stats\n## Method used: {method}\n## To find further sequence specific information, refer to table 03 generated previously\n**Please refer to the excel or csv file generated to perform further analysis.**\nDate file was generated: {time_generated}\n{asv_table_normalized.to_markdown()}'''
+    
+    def html():
+        return f'''<!doctype html>
     <html lang="en">
         <head>
             <meta charset="utf-8">
@@ -164,90 +115,19 @@ def stats_generator(asv_table: pd.DataFrame, outputdir: str, method:str, raw_asv
             <h2 >To find further sequence specific information, refer to table 03 generated previously.</h2>
             <strong>Please refer to the excel file generated to perform further analysis. </strong>
             <p>Date file was generated: {time_generated}</p>
-            {asv_table_normalized.to_html()}''')
-
-def borneman_prism_formatter(asv_table, map_file: Metadata, data_column: str, treatments: list, num: int, outputdir: str):
-    print("BORNEMAN PRISM FORMATTER")
-    pd.options.mode.chained_assignment = None
-    
-    #Ensure correct data format
-    if isinstance(asv_table, pd.DataFrame):
-        print('Table to be processed is a txt biom file')
-        asv_table=asv_table.set_index('#OTU ID')
-        asv_table.index.name = None
+            {asv_table_normalized.to_html()}'''
     
-    elif isinstance(asv_table, Artifact) and 'FeatureTable[RelativeFrequency]' in str(asv_table.view):
-        print('Table to be processed is a Qiime 2 Artifact')
-        asv_table=asv_table.T
-
-    else:
-        print('Invalid table type...')
-        exit(1)
-    
-    print('Treatments to be processed...')
-    for i in range(len(treatments)):
-        print(treatments[i], end='\t')
-    
-    n = len(treatments)
-    
-    dataframe_list=[]
-    for i in range(n):
-        
-        #Get the current treatment
-        current_treatment=treatments[i]
-
-        #Extract the samples from map file that are labeled with the current treatement
-        # *Uses qiime 2 Metdata function 'get_ids' to extract all samples from a treatment based on the map file 
-        samples = list(map_file.get_ids(f"[{data_column}]='{current_treatment}'"))
+    #Write every requested format at the same time
+    write_outputs(outputdir,
+                  {'top_n_stats': asv_table.T},
+                  {'md': ('top_n_stats.md', markdown), 'html': ('top_n_stats.html', html)},
+                  formats)
 
-        
-        #Create a temp dataframe which only contains samples related to current treatment
-        temp_df=asv_table[samples]
-        
-        #Get each ASVs total abundance across all current samples
-        # *Creates column in the temp dataframe with these values and label the column by the current treatment
-        temp_df[f'{current_treatment}'] = temp_df[temp_df.columns].sum(axis=1)
-        
-        #Remove samples from temp dataframe by extracting them from the data frame and dropping them
-        # *Ensures that 'treatment' column is the only one present
-        list_temp = temp_df.columns
-        list_temp = list_temp[0:len(list_temp)-1]
-        temp_df=temp_df.drop(columns=list_temp)
-        
-        #Append treatment dataframe to a list of dataframes
-        dataframe_list.append(temp_df)
-    
-    #Concate each dataframe from the data frame list by columns    
-    merged_data=pd.concat(dataframe_list, axis=1)
-    print("Grouped, and filtered down table...")
-    print(merged_data)
-    
-    counter = 0
-    curr_row = 0
-    treatments=merged_data.columns.to_list()
-    top_n_taxa = []
-    
+def borneman_top_taxa(merged_data: pd.DataFrame, num: int) -> pd.DataFrame:
+    #Top N rows of a grouped (ASVs x treatments) table, duplicate ASVs summed and
+    #sorted by the first treatment, plus an 'Other' row with the rest of every column
     #Finding top ASVs
-    while (counter < num):
-        #Extract treatment columns
-        for i in range(len(treatments)):
-            #Sort the merged data frame by current treatment
-            sorted_table=merged_data.sort_values(by=f'{treatments[i]}', ascending=False)
-            
-            #Get the taxa from the current row
-            taxa=sorted_table.iloc[curr_row].name
-            
-            #Check if taxa is not already in the top taxa list
-            if taxa not in top_n_taxa:
-                top_n_taxa.append(taxa)
-                counter+=1
-                
-            #If we still don't have the top N taxa then keep looping
-            if counter >= num:
-                break
-        
-        #Increase row counter
-        curr_row+=1
+    top_n_taxa = select_top_n_taxa(merged_data, num)
         
     #Create a 'Other' data frame which only has ASVs not in the top taxa list
     other_df=merged_data.drop(top_n_taxa,axis=0)
@@ -266,7 +146,7 @@ def borneman_prism_formatter(asv_table, map_file: Metadata, data_column: str, tr
     top_n_taxa=top_taxa_df.index.to_list()
     
     #Format ASV lables
-    asv_label_formatter(top_n_taxa)    
+    top_n_taxa = deepest_labels(top_n_taxa)
     top_n_taxa.append("Other")
     
     #Concat 'Other' dataframe to the top taxa dataframe
@@ -275,6 +155,46 @@ def borneman_prism_formatter(asv_table, map_file: Metadata, data_column: str, tr
     #Assign formatted labeling to dataframe
     top_taxa_df.index = top_n_taxa
     
+    return top_taxa_df
+
+def borneman_prism_formatter(asv_table, map_file: Metadata, data_column: str, treatments: list, num: int, outputdir: str):
+    print("BORNEMAN PRISM FORMATTER")
+    pd.options.mode.chained_assignment = None
+    
+    #Ensure correct data format
+    if isinstance(asv_table, BiomTsv):
+        print('Table to be processed is a txt biom file, reading it in chunks')
+    
+    elif isinstance(asv_table, pd.DataFrame):
+        print('Table to be processed is a txt biom file')
+        asv_table=asv_table.set_index('#OTU ID')
+        asv_table.index.name = None
+    
+    elif isinstance(asv_table, Artifact) and 'FeatureTable[RelativeFrequency]' in str(asv_table.view):
+        print('Table to be processed is a Qiime 2 Artifact')
+        asv_table=asv_table.T
+
+    else:
+        print('Invalid table type...')
+        exit(1)
+    
+    print('Treatments to be processed...')
+    for i in range(len(treatments)):
+        print(treatments[i], end='\t')
+    
+    #Map every sample to its treatment once, then group all treatments in one pass
+    mapping = treatment_mapping(map_file, data_column, treatments)
+    if isinstance(asv_table, BiomTsv):
+        #Reduce each chunk straight into per treatment sums
+        merged_data = group_biom_tsv(asv_table, mapping, treatments)
+    else:
+        merged_data = group_frame(asv_table, mapping, treatments)
+    print("Grouped, and filtered down table...")
+    print(merged_data)
+    
+    #Top N ASVs plus an 'Other' row holding the rest
+    top_taxa_df = borneman_top_taxa(merged_data, num)
+    
     print(f"Found top {num} ASVs...")
     print(top_taxa_df)
     top_taxa_df=top_taxa_df.T   
@@ -308,183 +228,97 @@ def qiime_formatter(asv_table: Artifact, map_file: Metadata, data_column: str, o
     asv_table_grouped_qzv = asv_table_grouped_qzv.visualization
     asv_table_grouped_qzv.save(f"{output}{data_column}")
 
-def biime_formatter(asv_table : Artifact, map_file : Metadata , col ,treatments, num, outputdir, plot_title, split_replicates : bool, filter: bool):
+def biime_top_taxa(merged_data, column_labels: list, feature_labels, num: int, exclude=None):
+    #Top N rows of a sparse grouped (ASVs x columns) table sorted by the first column,
+    #plus an 'Other' row with the rest of every column. Returns the table labelled by
+    #the deepest named rank and the raw ASV strings (for the stats file).
+    top_rows = select_top_n_taxa_sparse(merged_data, feature_labels, num, exclude)
+    top_rows = np.sort(top_rows)
+    
+    #Only densify the top taxa rows
+    top_taxa_df=densify_rows(merged_data.tocsr(), top_rows, feature_labels[top_rows], column_labels)
+    
+    #Get the total of 'Other' ASVs for each treatment and create dataframe out of these values
+    column_totals=np.asarray(merged_data.sum(axis=0)).ravel()
+    other_total=pd.DataFrame([column_totals-top_taxa_df.to_numpy().sum(axis=0)], index=['Other'], columns=column_labels)
+
+    
+    #Sort by the control sample (Currently hard coded to be the first column)
+    top_taxa_df=top_taxa_df.sort_values(by=top_taxa_df.columns.to_list()[0], ascending=False)
+    
+    top_n_taxa=top_taxa_df.index.to_list()
+    
+    #Extract raw ASV labels for stats file
+    raw_asv_strings=top_taxa_df.index.to_list()
+    raw_asv_strings.append("Other")
+    
+    #Format ASV lables
+    top_n_taxa = deepest_labels(top_n_taxa)
+
+    top_n_taxa.append("Other")
+    
+    #Concat 'Other' dataframe to the top taxa dataframe
+    top_taxa_df=pd.concat([top_taxa_df, other_total], axis=0, ignore_index=True)
+
+    #Assign formatted labeling to dataframe
+    top_taxa_df.index = top_n_taxa
+    
+    return top_taxa_df, raw_asv_strings
+
+def biime_formatter(asv_table : Artifact, map_file : Metadata , col ,treatments, num, outputdir, plot_title, split_replicates : bool, filter: bool, output_formats=None, preview: bool = False):
     print('BIIME FORMATTER')
     pd.options.mode.chained_assignment = None
     
     #Ensure correct data format
-    if 'FeatureTable[Frequency]' in str(asv_table.view):
+    if isinstance(asv_table, SparseFeatureTable):
+        print('Table to be processed is an already loaded sparse table')
+    elif 'FeatureTable[Frequency]' in str(asv_table.view):
         print('Table to be processed is a Qiime 2 Artifact')
+        
+        #Keep the feature table sparse (features x samples, int32 counts)
+        asv_table=SparseFeatureTable.from_artifact(asv_table)
     else:
         print('Invalid data type')
         exit(1)
 
-    asv_table=asv_table.view(pd.DataFrame)
-    asv_table=asv_table.T
-
     treatments=treatments[0].split(',')
     print('Treatments to be processed...')
     for i in range(len(treatments)):
         print(treatments[i], end='\t')
     
-    n = len(treatments)
-    
-    dataframe_list=[]
-    all_samples=asv_table.columns.to_list()
+    #Map every sample to its treatment once, then group all treatments in one pass
+    mapping = treatment_mapping(map_file, col, treatments)
     if split_replicates == False:
-        for i in range(n):
-            
-            #Get the current treatment
-            current_treatment=treatments[i]
-
-            #Extract the samples from map file that are labeled with the current treatement
-            # *Uses qiime 2 Metdata function 'get_ids' to extract all samples from a treatment based on the map file 
-            samples = list(map_file.get_ids(f"[{col}]='{current_treatment}'"))
-            filtered_samples = []
-            for sample in samples:
-                if sample not in all_samples:
-                    print(f"{sample} is not in the ASV table, please check raw counts file for this sequence run")
-                else:
-                    filtered_samples.append(sample)
-            samples = filtered_samples
-            #Create a temp dataframe which only contains samples related to current treatment
-            temp_df=asv_table[samples]
-            
-            #Get each ASVs total abundance across all current samples
-            #*Create column in the temp dataframe with these values and label the column by the current treatment
-            temp_df[f'{current_treatment}'] = temp_df[temp_df.columns].sum(axis=1)
-            
-            #Remove samples from temp dataframe by extracting them from the data frame and dropping them
-            # *Ensures that 'treatment' column is the only one present
-            list_temp = temp_df.columns
-            list_temp = list_temp[0:len(list_temp)-1]
-            temp_df=temp_df.drop(columns=list_temp)
-            
-            
-            #Append treatment dataframe to a list of dataframes
-            dataframe_list.append(temp_df)
+        #Sum each ASVs abundance across the samples of every treatment with one sparse multiply
+        merged_data, column_labels = group_sum(asv_table, mapping, treatments)
     else:
         print("\nSplit replicates")
         
-        for i in range(n):
-            current_treatment=treatments[i]
-            samples = list(map_file.get_ids(f"[{col}]='{current_treatment}'"))
-            filtered_samples = []
-            for sample in samples:
-                if sample not in all_samples:
-                    print(f"{sample} is not in the ASV table, please check raw counts file for this sequence run")
-                else:
-                    filtered_samples.append(sample)
-            samples = filtered_samples
-            temp_df=asv_table[samples]
-            print(temp_df)
-            #Change colum names
-            replicates=[]
-            for j in range(len(samples)):
-                replicates.append(current_treatment+'_'+samples[j])
-
-            temp_df.columns=replicates
-            print(temp_df)
-            #Append treatment dataframe to a list of dataframes
-            dataframe_list.append(temp_df)
-            
-    
-    #Concate each dataframe from the data frame list by columns    
-    merged_data=pd.concat(dataframe_list, axis=1)
+        #Keep each replicate as its own column, labelled by treatment and sample
+        merged_data, column_labels = split_replicates_columns(asv_table, mapping, treatments)
 
     print("Merged, grouped, and filtered down table...")
-    print(merged_data)
+    print(f"{merged_data.shape[0]} ASVs x {merged_data.shape[1]} columns, {merged_data.nnz} nonzero values")
 
-    counter = 0
-    curr_row = 0
-    treatments=merged_data.columns.to_list()
-    top_n_taxa = []
-    filter_for_list=["k__Bacteria;Other",
-  "k__Fungi;Other",
-  "k__Eukaryota;Other",
-  "k__Bacteria;p__unclassified_Bacteria",
-  "k__Fungi;p__unclassified_Fungi",
-  "k__Eukaryota;p__unclassified_Eukaryota",
-  "k__Bacteria_OR_k__unclassified_;Other",
-  "k__Fungi_OR_k__unclassified_;Other",
-  "k__Eukaryota_OR_k__unclassified_;Other",
-  "k__Unassigned;Other"]
     if filter == True:
         print('Filtering data for ambiguous ASVs')
     
     #Get the top N taxa
     print(f"Finding top {num} ASVs...")
-    while (counter < num):
-        
-        #Extract treatment columns
-        for i in range(len(treatments)):
-            #Sort the merged data frame by current treatment
-            sorted_table=merged_data.sort_values(by=f'{treatments[i]}', ascending=False)
-            
-            #Get the taxa from the current row
-            taxa=sorted_table.iloc[curr_row].name
-            
-            
-            #Check if taxa is not already in the top taxa list
-            if filter == True:
-                if taxa not in top_n_taxa and taxa not in filter_for_list:
-                    top_n_taxa.append(taxa)
-                    counter+=1
-            else:
-                if taxa not in top_n_taxa:
-                    top_n_taxa.append(taxa)
-                    counter+=1
-            
-            #If we still don't have the top N taxa then keep looping
-            if counter >= num:
-                break
-    
-        #Increase row counter
-        curr_row+=1
-    
-    #Create a 'Other' data frame which only has ASVs not in the top taxa list
-    other_df=merged_data.drop(top_n_taxa,axis=0)
-    
-    
-    #Create top taxa data frame which only has ASVs in the top taxa list
-    top_taxa_df=merged_data.drop(other_df.index, axis=0)
-    
-    #Get the total of 'Other' ASVs for each treatment and create dataframe out of these values
-    other_total=other_df[other_df.columns].sum(axis=0)
-    other_total=other_total.to_frame().T.rename(index={0: 'Other'})
-
-    
-    #Sort by the control sample (Currently hard coded to be the first column)
-    top_taxa_df=top_taxa_df.sort_values(by=top_taxa_df.columns.to_list()[0], ascending=False)
-    
-    top_n_taxa=top_taxa_df.index.to_list()
-    
-    #Extract raw ASV labels for stats file
-    raw_asv_strings=top_taxa_df.index.to_list()
-    raw_asv_strings.append("Other")
-    
-    #Format ASV lables
+    feature_labels=asv_table.features.astype(str).to_numpy()
+    top_taxa_df, raw_asv_strings = biime_top_taxa(merged_data, column_labels, feature_labels, num, AMBIGUOUS_TAXA if filter == True else None)
     print(raw_asv_strings)
-    asv_label_formatter(top_n_taxa)
-
-    top_n_taxa.append("Other")
-    
-    #Concat 'Other' dataframe to the top taxa dataframe
-    top_taxa_df=pd.concat([top_taxa_df, other_total], axis=0, ignore_index=True)
-
-    #Assign formatted labeling to dataframe
-    top_taxa_df.index = top_n_taxa
     
     print(f"Found top {num} ASVs...")
     print(top_taxa_df)
     
     print("Generating visualization...")
-    visualizer(top_taxa_df.T, plot_title, outputdir)
+    visualizer(top_taxa_df.T, plot_title, outputdir, preview)
 
     
 
     print("Generating stats files...")
-    stats_generator(top_taxa_df, outputdir, 'Beth Raw Counts Method', raw_asv_strings)
+    stats_generator(top_taxa_df, outputdir, 'Beth Raw Counts Method', raw_asv_strings, output_formats)
     
 
 def validate_data(asv_table) -> None:
@@ -495,26 +329,82 @@ def validate_data(asv_table) -> None:
         return asv_table
     
     #Check if data is biom txt file
+    # *Only the header is read here, the counts are streamed in chunks when grouping
     elif '.txt' in asv_table:
-        asv_table=pd.read_table(asv_table, comment='~', sep = "\t", skiprows = 1)
+        asv_table=BiomTsv(asv_table)
         return asv_table
 
     return None
 
+#Table and map file shared with the batch workers, loaded once by the parent process
+BATCH_DATA = {}
+
+def run_batch_job(job: dict) -> dict:
+    outputdir = job_output_dir(BATCH_DATA['output'], job)
+    print(f"Running job {job['name']}...")
+    try:
+        if job['formatter'] == 'b':
+            biime_formatter(BATCH_DATA['sparse_table'], BATCH_DATA['map_file'], job['column'], [','.join(job['treatments'])],
+                            job['top_n'], outputdir, job['title'], job['split_replicates'], job['filter'],
+                            job['formats'] or BATCH_DATA['output_formats'], BATCH_DATA['preview'])
+        elif job['formatter'] == 'j':
+            borneman_prism_formatter(BATCH_DATA['asv_table'], BATCH_DATA['map_file'], job['column'], job['treatments'],
+                                     job['top_n'], outputdir)
+        elif job['formatter'] == 'q':
+            qiime_formatter(BATCH_DATA['asv_table'], BATCH_DATA['map_file'], job['column'], outputdir)
+    #Formatters exit on invalid input, only fail the current job
+    except (Exception, SystemExit) as e:
+        print(f"Job {job['name']} failed: {e!r}")
+        return {'name': job['name'], 'output': outputdir, 'status': 'failed'}
+    finally:
+        plt.close('all')
+
+    return {'name': job['name'], 'output': outputdir, 'status': 'done'}
+
+def batch_mode(asv_table, map_file: Metadata, batch_file: str, workers: int, output: str, output_formats=None, preview: bool = False):
+    jobs = load_manifest(batch_file)
+    print(f"Loaded {len(jobs)} jobs from {batch_file}")
+    
+    BATCH_DATA['asv_table'] = asv_table
+    BATCH_DATA['map_file'] = map_file
+    BATCH_DATA['output'] = output
+    BATCH_DATA['output_formats'] = output_formats
+    BATCH_DATA['preview'] = preview
+    
+    #Load the sparse table once for every biime job instead of once per job
+    if any(job['formatter'] == 'b' for job in jobs) and not isinstance(asv_table, (pd.DataFrame, BiomTsv)):
+        BATCH_DATA['sparse_table'] = SparseFeatureTable.from_artifact(asv_table)
+    
+    results = run_jobs(jobs, run_batch_job, workers)
+    
+    print("Batch results...")
+    for result in results:
+        print(f"{result['name']}\t{result['status']}\t{result['output']}")
+    
+    if any(result['status'] == 'failed' for result in results):
+        exit(1)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(add_help=False, prog="taxa-bar-genator.py", description="Program to generate custom taxaonmy barplots")
     parser.add_argument('-i',"--input-file", required=True, help="Imported qza file",type=str)
     parser.add_argument('-m',"--map-file", required=True, help="Map file for data",type=str)
-    parser.add_argument('-c',"--column", required=True, help="Colmun to parse for data",type=str)
+    parser.add_argument('-c',"--column", help="Colmun to parse for data (Required unless running a batch file)",type=str)
     parser.add_argument('-p', "--plot-title", help="Tilte for plot",type=str)
-    parser.add_argument('-n', "--top-n-taxa", required=True, help="Filter for top N taxa",type=int)
+    parser.add_argument('-n', "--top-n-taxa", help="Filter for top N taxa (Required unless running a batch file)",type=int)
     parser.add_argument('-f', "--filter", action="store_true", help="Filter out any taxa (Default is viruses)")
-    parser.add_argument('-t', "--formatter-type", required=True, help="Type of formatter to process data with\nb = Biime Formatter\nj=Borneman prism formatter\nq=Qiime 2 Formatter", type=str)
+    parser.add_argument('-t', "--formatter-type", help="Type of formatter to process data with\nb = Biime Formatter\nj=Borneman prism formatter\nq=Qiime 2 Formatter", type=str)
     parser.add_argument('-l', "--treatments", nargs='+', type=str, help="Treatments to process")
     parser.add_argument('-d', "--output-dir", required=True, help="Output directory location",type=str)
     parser.add_argument('-s', "--split-replicates", action="store_true", help="Keep replicates ungrouped")
+    parser.add_argument('-b', "--batch-file", help="YAML/JSON manifest of jobs to run against the same table and map file",type=str)
+    parser.add_argument("--output-formats", nargs='+', type=str, help=f"Stats file formats to write ({', '.join(OUTPUT_FORMATS)}), Default is xlsx md html")
+    parser.add_argument("--preview", action="store_true", help="Also save a quick low resolution <title>_preview.png next to the final 300 dpi plot")
+    parser.add_argument('-w', "--workers", default=1, help="Number of worker processes for batch jobs (Default is 1)",type=int)
     parser.add_argument('-h', '--help', action='help', default=argparse.SUPPRESS, help='Display commands possible with this program.')
     args = parser.parse_args()
+    
+    if args.batch_file is None and (args.column is None or args.formatter_type is None or (args.top_n_taxa is None and args.formatter_type != 'q')):
+        parser.error("--column, --formatter-type and --top-n-taxa are required unless --batch-file is given")
 
     data_file=args.input_file
     map_file=args.map_file
@@ -526,12 +416,21 @@ if __name__ == '__main__':
     title=args.plot_title
     split_replicates=args.split_replicates
     filter=args.filter
+    batch_file=args.batch_file
+    workers=args.workers
+    preview=args.preview
+    try:
+        output_formats=parse_formats(args.output_formats)
+    except ValueError as e:
+        parser.error(str(e))
     
     if ((asv_table := validate_data(data_file)) != None) and ((map_file := Metadata.load(map_file)) != None):
         if not os.path.exists(output):
             os.mkdir(output)
-        if formatter_type == 'b':
-            biime_formatter(asv_table, map_file, data_column, treatments, n_taxa, output, title, split_replicates, filter)
+        if batch_file is not None:
+            batch_mode(asv_table, map_file, batch_file, workers, output, output_formats, preview)
+        elif formatter_type == 'b':
+            biime_formatter(asv_table, map_file, data_column, treatments, n_taxa, output, title, split_replicates, filter, output_formats, preview)
         elif formatter_type == 'j':
             borneman_prism_formatter(asv_table, map_file, data_column, treatments, n_taxa, output)
         elif formatter_type == 'q':